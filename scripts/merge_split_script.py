@@ -39,6 +39,7 @@ from spikeinterface.widgets import plot_agreement_matrix
 from spike_psvae.cluster_utils import make_sorting_from_labels_frames, compute_cluster_centers, relabel_by_depth, run_weighted_triage, remove_duplicate_units
 from spike_psvae.cluster_utils import get_agreement_indices, compute_spiketrain_agreement, get_unit_similarities, compute_shifted_similarity, read_waveforms
 from spike_psvae.cluster_utils import get_closest_clusters_hdbscan, get_closest_clusters_kilosort, get_closest_clusters_hdbscan_kilosort, get_closest_clusters_kilosort_hdbscan
+from spike_psvae.cluster_utils import closest_channels_by_depth
 
 from spike_psvae.merge_split import split_clusters, get_templates, get_merged
 from spike_psvae.denoise import SingleChanDenoiser
@@ -335,8 +336,8 @@ plt.close(fig)
 #         firstchans_cluster_sorting1 = triaged_firstchans[ordered_merged_labels == cluster_id]
 #         mcs_abs_cluster_sorting1 = triaged_mcs_abs[ordered_merged_labels == cluster_id]
 #         spike_depths = kilo_spike_depths[np.where(kilo_spike_clusters==cluster_id_match)]
-#         mcs_abs_cluster_sorting2 = np.asarray([np.argmin(np.abs(spike_depth - geom_array[:,1])) for spike_depth in spike_depths])
-#         firstchans_cluster_sorting2 = (mcs_abs_cluster_sorting2 - 20).clip(min=0)
+#         mcs_abs_cluster_sorting2 = closest_channels_by_depth(geom_array, spike_depths)
+#         firstchans_cluster_sorting2 = np.maximum(mcs_abs_cluster_sorting2 - 20, 0)
 #         fig = plot_agreement_venn(cluster_id, cluster_id_match, cmp, sorting1, sorting2, sorting1_name, sorting2_name, geom_array, num_channels, num_spikes_plot, firstchans_cluster_sorting1, mcs_abs_cluster_sorting1, 
 #                             firstchans_cluster_sorting2, mcs_abs_cluster_sorting2, raw_data_bin, delta_frames = 12)
 #         fig.savefig('kilosort_agreement_plots/unit_'+str(cluster_id)+'.png', dpi = 100)
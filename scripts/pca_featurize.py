@@ -1,10 +1,42 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import h5py
 import numpy as np
-from sklearn.decomposition import IncrementalPCA
-from tqdm.auto import trange
+import torch
+from tqdm.auto import tqdm
+
+from spike_psvae import localize_torch, point_source_centering
+from spike_psvae.torch_pca import TorchIncrementalPCA, TorchRandomizedPCA
+
+
+def prefetch_batches(dataset, bounds, buffers, scale=1.0):
+    """Yield (start, end, batch) while the next batch loads in the background
+
+    Reads alternate between the two `buffers`, so the batch being read is
+    never the one that the caller is currently working on. If the dataset
+    is stored quantized (say, int16 with a "scale" attribute), it is read as
+    stored and dequantized into the float `buffers` as `scale * data`.
+    """
+    raw = buffers
+    if buffers[0].dtype != dataset.dtype:
+        raw = [np.empty(buf.shape, dtype=dataset.dtype) for buf in buffers]
+
+    def read(i):
+        start, end = bounds[i]
+        n = end - start
+        dataset.read_direct(raw[i % 2], np.s_[start:end], np.s_[:n])
+        if raw is not buffers:
+            np.multiply(raw[i % 2][:n], scale, out=buffers[i % 2][:n])
+        return buffers[i % 2][:n]
 
-from spike_psvae import localization, point_source_centering
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(read, 0) if bounds else None
+        for i, (start, end) in enumerate(bounds):
+            batch = future.result()
+            if i + 1 < len(bounds):
+                future = pool.submit(read, i + 1)
+            yield start, end, batch
 
 
 ap = argparse.ArgumentParser()
@@ -17,17 +49,38 @@ ap.add_argument("output_h5")
 ap.add_argument("--n_components", type=int, default=5, required=False)
 ap.add_argument("--batch_size", type=int, default=8192, required=False)
 ap.add_argument("--maxchans_key", default="max_channels", required=False)
-ap.add_argument("--n_workers", type=int, default=1, required=False)
 ap.add_argument("--relocate_dims", type=str, default="yza", required=False)
+ap.add_argument("--chunk_cache_mb", type=int, default=256, required=False)
+ap.add_argument("--device", default=None, required=False)
+# project each batch right after fitting it, rather than re-reading all of
+# the waveforms in a second pass. loadings are then only approximately
+# those of the final PCA, so the first few batches (fit while the
+# components were moving the most) are projected again at the end.
+ap.add_argument("--single_pass", action="store_true")
+ap.add_argument("--n_reproject", type=int, default=4, required=False)
+# randomized: streamed passes of matmuls and one small SVD at the end, in
+# place of an SVD per batch. it needs an (N, K + n_oversamples) sketch in
+# memory, and --single_pass does not apply. on top of its two passes, each
+# of the --n_power_iter power iterations costs two more. without them, the
+# noise floor of the waveforms leaks into the sketch and the components
+# can be far from the incremental PCA's.
+ap.add_argument(
+    "--method",
+    choices=["incremental", "randomized"],
+    default="incremental",
+    required=False,
+)
+ap.add_argument("--n_oversamples", type=int, default=10, required=False)
+ap.add_argument("--n_power_iter", type=int, default=4, required=False)
 
 args = ap.parse_args()
 batch_size = args.batch_size
 
 K = args.n_components
-ipca_orig = IncrementalPCA(n_components=K)
-ipca_reloc = IncrementalPCA(n_components=K)
 
-input_h5 = h5py.File(args.input_h5, "r+")
+# a raw chunk cache big enough to hold a full batch worth of chunks
+h5_kw = dict(rdcc_nbytes=args.chunk_cache_mb * 1024 * 1024, rdcc_nslots=1_000_003)
+input_h5 = h5py.File(args.input_h5, "r+", **h5_kw)
 waveforms = input_h5[args.input_dataset]
 spike_index = input_h5["spike_index"][:]
 maxchans_key = None
@@ -35,28 +88,71 @@ if args.maxchans_key in input_h5:
     maxchans = input_h5[args.maxchans_key][:]
 geom = input_h5["geom"][:]
 N, T, C = waveforms.shape
+if waveforms.chunks is not None:
+    # step through the data a whole number of chunks at a time, so that
+    # each chunk is decompressed once rather than once per batch it touches
+    chunk_rows = waveforms.chunks[0]
+    batch_size = chunk_rows * max(1, round(batch_size / chunk_rows))
 assert C < geom.shape[0]
 geomkind = "standard" if (C // 2) % 2 else "updown"
 firstchans = None
 if "first_channels" in input_h5:
-    firstchans = input_h5["first_channels"]
+    firstchans = input_h5["first_channels"][:]
     geomkind = "firstchan"
 print("geomkind is", geomkind)
 
 channel_radius = C // 2
 print(N, T, C)
+
+# batches are read straight into these buffers, rather than allocating
+# a fresh array for each waveforms[start:end]. there are two so that the
+# next batch can be read while the current one is being processed.
+# waveforms may be stored as integers with a scale, which halves the
+# bytes read relative to float32. they are dequantized batch by batch.
+wfs_dtype = waveforms.dtype
+wfs_scale = waveforms.attrs.get("scale", 1.0)
+if not np.issubdtype(wfs_dtype, np.floating):
+    wfs_dtype = np.float32
+wfs_bufs = [np.empty((batch_size, T, C), dtype=wfs_dtype) for _ in "ab"]
+# relocate_simple writes its output here
+reloc_buf = np.empty((batch_size, T, C), dtype=wfs_dtype)
+# full batches, then the N % batch_size leftover spikes as one last batch
+nfull = N // batch_size
+bounds = [(b * batch_size, (b + 1) * batch_size) for b in range(nfull)]
+if N > nfull * batch_size:
+    bounds.append((nfull * batch_size, N))
+
+# relocation and localization work on contiguous blocks of channels
+loc_firstchans = firstchans
+if loc_firstchans is None:
+    loc_firstchans = np.clip(maxchans - channel_radius, 0, len(geom) - C)
+
 if "x" not in input_h5:
-    xs, ys, z_rels, z_abss, alphas = localization.localize_waveforms_batched(
-        waveforms,
-        geom,
-        maxchans=maxchans,
-        channel_radius=channel_radius,
-        n_workers=args.n_workers,
-        jac=False,
-        firstchans=firstchans,
-        geomkind=geomkind,
-        batch_size=1024,
-    )
+    # all spikes in a batch are fit together by batched LM in torch,
+    # rather than one scipy.optimize call per spike in a process pool
+    xs = np.empty(N)
+    ys = np.empty(N)
+    z_rels = np.empty(N)
+    z_abss = np.empty(N)
+    alphas = np.empty(N)
+    for start, end, wfs in tqdm(
+        prefetch_batches(waveforms, bounds, wfs_bufs, wfs_scale),
+        total=len(bounds),
+        desc="localize",
+    ):
+        locs = localize_torch.localize_ptps_firstchans_lm(
+            np.ptp(wfs, axis=1),
+            geom,
+            loc_firstchans[start:end],
+            maxchans[start:end],
+        )
+        # the fit returns torch tensors
+        x, y, z_rel, z_abs, alpha = (loc.cpu().numpy() for loc in locs)
+        xs[start:end] = x
+        ys[start:end] = y
+        z_rels[start:end] = z_rel
+        z_abss[start:end] = z_abs
+        alphas[start:end] = alpha
 else:
     xs = input_h5["x"][:]
     ys = input_h5["x"][:]
@@ -65,7 +161,7 @@ else:
     alphas = input_h5["alpha"][:]
 
 if args.output_h5 != args.input_h5:
-    output_h5 = h5py.File(args.output_h5, "w-")
+    output_h5 = h5py.File(args.output_h5, "w-", **h5_kw)
     output_h5.create_dataset("geom", data=geom)
     output_h5.create_dataset("x", data=xs)
     output_h5.create_dataset("y", data=ys)
@@ -76,77 +172,111 @@ if args.output_h5 != args.input_h5:
 else:
     output_h5 = input_h5
 
-for b in trange((N + 1) // batch_size, desc="fit"):
-    start = b * batch_size
-    end = min(N, (b + 1) * batch_size)
-
-    wfs_orig = waveforms[start:end]
-    B, _, _ = wfs_orig.shape
-    wfs_reloc, r, q = point_source_centering.relocate_simple(
-        wfs_orig,
-        geom,
-        maxchans[start:end],
-        xs[start:end],
-        ys[start:end],
-        z_rels[start:end],
-        alphas[start:end],
-        channel_radius=channel_radius,
-        firstchans=firstchans[start:end] if firstchans else None,
-        geomkind=geomkind,
-        relocate_dims=args.relocate_dims,
-        interp_xz=False,
-    )
-
-    ipca_orig.partial_fit(wfs_orig.reshape(B, -1))
-    ipca_reloc.partial_fit(wfs_reloc.reshape(B, -1))
-
-loadings_orig = np.empty((N, K))
-loadings_reloc = np.empty((N, K))
-for b in trange((N + 1) // batch_size, desc="project"):
-    start = b * batch_size
-    end = min(N, (b + 1) * batch_size)
-
-    wfs_orig = waveforms[start:end]
-    B, _, _ = wfs_orig.shape
-    wfs_reloc, r, q = point_source_centering.relocate_simple(
-        wfs_orig,
-        geom,
-        maxchans[start:end],
-        xs[start:end],
-        ys[start:end],
-        z_rels[start:end],
-        alphas[start:end],
-        channel_radius=channel_radius,
-        firstchans=firstchans[start:end] if firstchans else None,
-        geomkind=geomkind,
-        relocate_dims=args.relocate_dims,
-        interp_xz=False,
-    )
-    wfs_orig = wfs_orig.reshape(end - start, -1)
-    wfs_reloc = wfs_reloc.reshape(end - start, -1)
-
-    loadings_orig[start:end] = ipca_orig.transform(wfs_orig)
-    loadings_reloc[start:end] = ipca_reloc.transform(wfs_reloc)
-
-if "loadings_orig" not in output_h5:
-    output_h5.create_dataset("loadings_orig", data=loadings_orig)
-    output_h5.create_dataset(
-        "pcs_orig", data=ipca_orig.components_.reshape(K, T, C)
-    )
-if "mean_orig" not in output_h5:
-    output_h5.create_dataset(
-        "mean_orig", data=ipca_orig.mean_.reshape(T, C)
-    )
-if f"loadings_{args.relocate_dims}" in output_h5:
-    del output_h5[f"loadings_{args.relocate_dims}"]
-if f"pcs_{args.relocate_dims}" in output_h5:
-    del output_h5[f"pcs_{args.relocate_dims}"]
-if f"mean_{args.relocate_dims}" in output_h5:
-    del output_h5[f"mean_{args.relocate_dims}"]
-output_h5.create_dataset(f"loadings_{args.relocate_dims}", data=loadings_reloc)
-output_h5.create_dataset(
-    f"pcs_{args.relocate_dims}", data=ipca_reloc.components_.reshape(K, T, C)
+def replace_dataset(name, **kwargs):
+    if name in output_h5:
+        del output_h5[name]
+    return output_h5.create_dataset(name, **kwargs)
+
+
+# relocation is a per-spike, per-channel rescaling by r / q. the scales are
+# kept after the first pass over a batch, so that later passes relocate
+# with a single multiply instead of re-evaluating the point source model.
+reloc_scales = np.empty((N, C), dtype=wfs_dtype)
+have_scales = np.zeros(N, dtype=bool)
+
+
+def flat_batches(bounds, desc):
+    """Yield (start, end, original, relocated) flattened waveform batches"""
+    for start, end, wfs_orig in tqdm(
+        prefetch_batches(waveforms, bounds, wfs_bufs, wfs_scale),
+        total=len(bounds),
+        desc=desc,
+    ):
+        B = end - start
+        if have_scales[start:end].all():
+            wfs_reloc = torch.mul(
+                torch.as_tensor(wfs_orig),
+                torch.as_tensor(reloc_scales[start:end, None]),
+                out=torch.as_tensor(reloc_buf[:B]),
+            )
+        else:
+            wfs_reloc, r, q = point_source_centering.relocate_simple(
+                wfs_orig,
+                geom,
+                loc_firstchans[start:end],
+                maxchans[start:end],
+                xs[start:end],
+                ys[start:end],
+                z_abss[start:end],
+                alphas[start:end],
+                relocate_dims=args.relocate_dims,
+                out=reloc_buf[:B],
+            )
+            reloc_scales[start:end] = (r.view(B, C) / q).numpy()
+            have_scales[start:end] = True
+
+        # flatten once, and make sure that it's a view: the read buffer slice
+        # is C-contiguous, and copies here would be (B, T*C) each
+        wfs_orig = wfs_orig.reshape(B, -1)
+        wfs_reloc = wfs_reloc.reshape(B, -1)
+        assert wfs_orig.flags.c_contiguous and wfs_reloc.is_contiguous()
+        yield start, end, wfs_orig, wfs_reloc
+
+
+# loadings are written batch by batch, rather than held in memory
+loadings_kw = dict(shape=(N, K), chunks=(min(N, batch_size), K), dtype=np.float64)
+loadings_orig = replace_dataset("loadings_orig", **loadings_kw)
+loadings_reloc = replace_dataset(f"loadings_{args.relocate_dims}", **loadings_kw)
+
+if args.method == "randomized":
+    pca_kw = dict(n_oversamples=args.n_oversamples, device=args.device)
+    pca_orig = TorchRandomizedPCA(K, N, T * C, **pca_kw)
+    pca_reloc = TorchRandomizedPCA(K, N, T * C, **pca_kw)
+    for i in range(args.n_power_iter + 1):
+        if i:
+            desc = f"power iteration {i}/{args.n_power_iter}"
+            for start, end, wfs_orig, wfs_reloc in flat_batches(bounds, desc):
+                pca_orig.accumulate(start, wfs_orig)
+                pca_reloc.accumulate(start, wfs_reloc)
+            pca_orig.power_iteration()
+            pca_reloc.power_iteration()
+        for start, end, wfs_orig, wfs_reloc in flat_batches(bounds, "sketch"):
+            pca_orig.sketch(start, wfs_orig)
+            pca_reloc.sketch(start, wfs_reloc)
+        pca_orig.end_sketch()
+        pca_reloc.end_sketch()
+    for start, end, wfs_orig, wfs_reloc in flat_batches(bounds, "fit"):
+        pca_orig.accumulate(start, wfs_orig)
+        pca_reloc.accumulate(start, wfs_reloc)
+    pca_orig.finish()
+    pca_reloc.finish()
+    for start, end in bounds:
+        loadings_orig[start:end] = pca_orig.loadings_[start:end].cpu().numpy()
+        loadings_reloc[start:end] = pca_reloc.loadings_[start:end].cpu().numpy()
+else:
+    pca_orig = TorchIncrementalPCA(n_components=K, device=args.device)
+    pca_reloc = TorchIncrementalPCA(n_components=K, device=args.device)
+    for start, end, wfs_orig, wfs_reloc in flat_batches(bounds, "fit"):
+        pca_orig.partial_fit(wfs_orig)
+        pca_reloc.partial_fit(wfs_reloc)
+        if args.single_pass:
+            loadings_orig[start:end] = pca_orig.transform(wfs_orig)
+            loadings_reloc[start:end] = pca_reloc.transform(wfs_reloc)
+
+    project_bounds = bounds[: args.n_reproject] if args.single_pass else bounds
+    for start, end, wfs_orig, wfs_reloc in flat_batches(project_bounds, "project"):
+        loadings_orig[start:end] = pca_orig.transform(wfs_orig)
+        loadings_reloc[start:end] = pca_reloc.transform(wfs_reloc)
+
+replace_dataset(
+    "pcs_orig", data=pca_orig.components_.cpu().numpy().reshape(K, T, C)
+)
+replace_dataset("mean_orig", data=pca_orig.mean_.cpu().numpy().reshape(T, C))
+replace_dataset(
+    f"pcs_{args.relocate_dims}",
+    data=pca_reloc.components_.cpu().numpy().reshape(K, T, C),
 )
-output_h5.create_dataset(
-    f"mean_{args.relocate_dims}", data=ipca_reloc.mean_.reshape(T, C)
+replace_dataset(
+    f"mean_{args.relocate_dims}",
+    data=pca_reloc.mean_.cpu().numpy().reshape(T, C),
 )
@@ -471,8 +471,12 @@ def compute_spiketrain_agreement(st_1, st_2, delta_frames=12):
     )
 
     if len(inds) > 0:
-        inds2 = inds[np.where(inds[:-1] + 1 != inds[1:])[0]] + 1
-        inds2 = np.concatenate((inds2, [inds[-1]]))
+        # last index of each run of consecutive matches, shifted to the
+        # run's final spike (except for the last run)
+        run_ends = np.ones(len(inds), dtype=bool)
+        np.not_equal(inds[1:], inds[:-1] + 1, out=run_ends[:-1])
+        inds2 = inds[run_ends]
+        inds2[:-1] += 1
         times_matched = times_concat_sorted[inds2]
         # # find and label closest spikes
         ind_st1 = np.array([np.abs(st_1 - tm).argmin() for tm in times_matched])
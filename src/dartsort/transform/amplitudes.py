@@ -1,5 +1,6 @@
 import torch
-from dartsort.util.spiketorch import ptp
+from dartsort.util.spiketorch import absmax, ptp
+from dartsort.util.waveform_util import grab_main_channels_torch
 
 from .transform_base import BaseWaveformFeaturizer
 
@@ -72,13 +73,12 @@ class AmplitudeFeatures(BaseWaveformFeaturizer):
     def transform(self, waveforms, max_channels=None):
         features = {}
         if self.peak_amplitude_vectors:
-            features[self.peak_amplitude_vectors_name] = (
-                waveforms.abs().max(dim=1).values
-            )
+            features[self.peak_amplitude_vectors_name] = absmax(waveforms, dim=1)
 
         if self.compute_minmax_vectors:
-            max_vectors = torch.nan_to_num(waveforms.max(dim=1).values)
-            min_vectors = torch.nan_to_num(waveforms.min(dim=1).values)
+            min_vectors, max_vectors = torch.aminmax(waveforms, dim=1)
+            min_vectors = torch.nan_to_num(min_vectors)
+            max_vectors = torch.nan_to_num(max_vectors)
             ptp_vectors = max_vectors - min_vectors
         if self.compute_maxchan:
             maxchans = torch.argmax(torch.nan_to_num(ptp_vectors), dim=1, keepdim=True)
@@ -112,6 +112,7 @@ class AmplitudeVector(BaseWaveformFeaturizer):
         dtype=torch.float,
         name=None,
         name_prefix="",
+        compute_dtype=None,
     ):
         assert kind in ("peak", "ptp")
         if name is None:
@@ -122,12 +123,21 @@ class AmplitudeVector(BaseWaveformFeaturizer):
         self.kind = kind
         self.shape = (channel_index.shape[1],)
         self.dtype = dtype
+        # amplitudes are robust to half precision, so the reductions can run
+        # in float16/bfloat16 and be cast back. this only saves memory
+        # traffic when the waveforms already arrive in that dtype (then the
+        # cast is a no-op): casting float32 waveforms is one more full read
+        # and write before the reduction starts.
+        self.compute_dtype = compute_dtype
 
     def transform(self, waveforms, max_channels=None):
+        if self.compute_dtype is not None:
+            waveforms = waveforms.to(self.compute_dtype)
         if self.kind == "peak":
-            return {self.name: waveforms.abs().max(dim=1).values}
+            amplitudes = absmax(waveforms, dim=1)
         elif self.kind == "ptp":
-            return {self.name: ptp(waveforms, dim=1)}
+            amplitudes = ptp(waveforms, dim=1)
+        return {self.name: amplitudes.to(self.dtype)}
 
 
 class MaxAmplitude(BaseWaveformFeaturizer):
@@ -142,23 +152,44 @@ class MaxAmplitude(BaseWaveformFeaturizer):
         dtype=torch.float,
         name=None,
         name_prefix="",
+        main_channel_only=False,
     ):
         assert kind in ("peak", "ptp")
         if name is None:
             name = f"{kind}_{self.default_name}"
             if name_prefix:
                 name = f"{name_prefix}_{name}"
-        super().__init__(name=name, name_prefix=name_prefix)
+        # with main_channel_only, the amplitude is measured on each spike's
+        # max channel only, rather than maximized over its neighborhood
+        if main_channel_only:
+            assert channel_index is not None
+        else:
+            channel_index = None
+        super().__init__(
+            name=name, name_prefix=name_prefix, channel_index=channel_index
+        )
         self.kind = kind
         self.dtype = dtype
+        self.main_channel_only = main_channel_only
 
     def transform(self, waveforms, max_channels=None):
+        if self.main_channel_only:
+            if max_channels is None:
+                raise ValueError(
+                    "MaxAmplitude with main_channel_only=True requires max_channels."
+                )
+            # gather before reducing, so the reductions below are over one
+            # channel rather than the whole neighborhood
+            waveforms = grab_main_channels_torch(
+                waveforms, max_channels, self.channel_index
+            )
+        # NaNs (missing channels) are zeroed in place on the reduced (N, C)
+        # amplitudes, which are nonnegative, so no cleaned copy is made
         if self.kind == "peak":
-            return {self.name: torch.nan_to_num(waveforms.abs()).max(dim=(1, 2)).values}
+            amplitudes = absmax(waveforms, dim=1)
         elif self.kind == "ptp":
-            return {
-                self.name: torch.nan_to_num(ptp(waveforms, dim=1)).max(dim=1).values
-            }
+            amplitudes = ptp(waveforms, dim=1)
+        return {self.name: torch.amax(amplitudes.nan_to_num_(), dim=1)}
 
 
 class Voltage(BaseWaveformFeaturizer):
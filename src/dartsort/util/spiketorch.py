@@ -32,7 +32,18 @@ def ptp(waveforms, dim=1):
     is_tensor = torch.is_tensor(waveforms)
     if not is_tensor:
         return np.ptp(waveforms, axis=dim)
-    return waveforms.max(dim=dim).values - waveforms.min(dim=dim).values
+    # aminmax finds both extrema in one pass over memory
+    mins, maxs = torch.aminmax(waveforms, dim=dim)
+    return maxs - mins
+
+
+def absmax(waveforms, dim=1):
+    is_tensor = torch.is_tensor(waveforms)
+    if not is_tensor:
+        return np.abs(waveforms).max(axis=dim)
+    # the inf-norm reduces |x| in a single pass, rather than materializing
+    # waveforms.abs() and then reducing that
+    return torch.linalg.vector_norm(waveforms, ord=torch.inf, dim=dim)
 
 
 def taper(waveforms, t_start=10, t_end=20, dim=1):
@@ -1,3 +1,7 @@
+import hashlib
+from functools import lru_cache
+
+import numba
 import numpy as np
 import spikeinterface
 from spikeinterface.comparison import compare_two_sorters
@@ -8,6 +12,7 @@ from spike_psvae.spikeio import read_waveforms
 from spike_psvae.spike_train_utils import make_labels_contiguous
 from tqdm.auto import tqdm
 import scipy
+from joblib import Parallel, delayed
 
 
 def compute_shifted_similarity(template1, template2, shifts=[0]):
@@ -34,6 +39,178 @@ def compute_shifted_similarity(template1, template2, shifts=[0]):
     return np.min(curr_similarities), shifts[np.argmin(curr_similarities)]
 
 
+def spike_train_getter(sorting):
+    """sorting.get_unit_spike_train, caching each unit's spike train
+
+    Sortings which can precompute all of their spike trains at once (newer
+    spikeinterface) are asked to, so each first lookup is cheap too.
+    """
+    if hasattr(sorting, "precompute_spike_trains"):
+        sorting.precompute_spike_trains()
+    return lru_cache(maxsize=None)(sorting.get_unit_spike_train)
+
+
+def median_template(st, raw_data_bin, n_channels, template_cache=None):
+    """Median of the raw waveforms at spike times `st`
+
+    Pass a dict as `template_cache` to keep templates between calls. They
+    are keyed by the binary's path and the spike train's contents, so
+    looping over units (each unit's neighbors are mostly the same few
+    units) reads each unit's waveforms from disk once.
+    """
+    return median_templates([st], raw_data_bin, n_channels, template_cache)[0]
+
+
+def median_templates(
+    spike_trains,
+    raw_data_bin,
+    n_channels,
+    template_cache=None,
+    max_spikes_per_read=5000,
+    n_jobs=1,
+    channels=None,
+):
+    """median_template for each of several spike trains
+
+    Trains are grouped into reads of up to `max_spikes_per_read` spikes
+    (a larger train is read on its own). Each read gathers its trains'
+    spikes in time order from the binary in one pass, rather than one
+    pass per train, while the cap bounds the memory used for waveforms.
+    With `n_jobs` > 1, that many reads run at once in threads (reading
+    and the medians release the GIL), using up to `n_jobs` times the
+    memory.
+
+    If `channels` is given, only those channels are read and the
+    templates are (T, len(channels)). Full-probe templates already in
+    the cache are sliced instead of read.
+    """
+    templates = [None] * len(spike_trains)
+    keys = [None] * len(spike_trains)
+    if template_cache is not None:
+        if channels is not None:
+            channels = np.asarray(channels)
+            channels_key = channels.tobytes()
+        for i, st in enumerate(spike_trains):
+            st = np.asarray(st)
+            digest = hashlib.blake2b(st.tobytes()).digest()
+            full_key = (str(raw_data_bin), st.dtype.str, len(st), digest)
+            keys[i] = full_key
+            if channels is not None:
+                keys[i] = (*full_key, channels_key)
+                if full_key in template_cache:
+                    templates[i] = template_cache[full_key][:, channels]
+                    continue
+            templates[i] = template_cache.get(keys[i])
+
+    def read_batch(batch):
+        times = np.concatenate([spike_trains[i] for i in batch])
+        owners = np.repeat(batch, [len(spike_trains[i]) for i in batch])
+        order = np.argsort(times, kind="stable")
+        waveforms, skipped = read_waveforms(
+            times[order], raw_data_bin, n_channels, channels=channels
+        )
+        kept = np.ones(len(times), dtype=bool)
+        kept[skipped] = False
+        owners = owners[order][kept]
+        return [np.median(waveforms[owners == i], axis=0) for i in batch]
+
+    batches = []
+    batch_spikes = 0
+    for i, st in enumerate(spike_trains):
+        if templates[i] is not None:
+            continue
+        if not batches or batch_spikes + len(st) > max_spikes_per_read:
+            batches.append([])
+            batch_spikes = 0
+        batches[-1].append(i)
+        batch_spikes += len(st)
+
+    batch_templates = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(read_batch)(batch) for batch in batches
+    )
+    for batch, medians in zip(batches, batch_templates):
+        for i, template in zip(batch, medians):
+            templates[i] = template
+            if keys[i] is not None:
+                template_cache[keys[i]] = template
+
+    return templates
+
+
+def compute_shifted_similarities(
+    template1, templates, shifts=[0], metric="maxabs"
+):
+    """compute_shifted_similarity between template1 and each of templates
+
+    All of the (n, T, C) templates are compared at once for each shift.
+    Returns the (n,) best similarities and the shift giving each.
+
+    `metric` is "maxabs" for the max absolute difference used by
+    compute_shifted_similarity, or "cosine" for the cosine distance,
+    which ignores the templates' amplitudes. Lower is more similar
+    either way.
+    """
+    if metric not in ("maxabs", "cosine"):
+        raise ValueError(f"Unknown similarity metric {metric}.")
+    flat1 = template1.T.ravel()
+    flat2 = templates.transpose(0, 2, 1).reshape(len(templates), flat1.size)
+    shifted = np.empty_like(flat2)
+    shift_similarities = np.empty(
+        (len(shifts), len(templates)), dtype=np.result_type(flat1, flat2)
+    )
+    for j, shift in enumerate(shifts):
+        # zero-padded shift of each flattened template, as in
+        # compute_shifted_similarity
+        if shift < 0:
+            shifted[:, :-shift] = 0
+            shifted[:, -shift:] = flat2[:, :shift]
+        elif shift > 0:
+            shifted[:, :-shift] = flat2[:, shift:]
+            shifted[:, -shift:] = 0
+        else:
+            shifted[:] = flat2
+        if metric == "maxabs":
+            shift_similarities[j] = np.abs(flat1 - shifted).max(
+                axis=1, initial=0
+            )
+        else:
+            norms = np.linalg.norm(shifted, axis=1) * np.linalg.norm(flat1)
+            shift_similarities[j] = 1 - (shifted @ flat1) / norms
+    best = shift_similarities.argmin(axis=0)
+    similarities = shift_similarities[best, np.arange(len(templates))]
+    return similarities, np.asarray(shifts)[best]
+
+
+def template_channel_window(template, num_channels_similarity=20):
+    """Channels around a (T, C) template's max ptp channel
+
+    Returns the template on `num_channels_similarity` channels centered
+    on its max ptp channel (fewer at the edges of the probe), the
+    (start, end) channel range, and the max ptp channel.
+    """
+    max_ptp_channel = np.ptp(template, axis=0).argmax()
+    channel_range = (
+        max(max_ptp_channel - num_channels_similarity // 2, 0),
+        min(
+            max_ptp_channel + num_channels_similarity // 2,
+            template.shape[1],
+        ),
+    )
+    window = template[:, channel_range[0] : channel_range[1]]
+    return window, channel_range, max_ptp_channel
+
+
+def smallest_k_order(values, k):
+    """Indices of the k smallest values, in increasing order of value
+
+    Only those k are sorted, after an argpartition to find them.
+    """
+    if k >= len(values):
+        return np.argsort(values)
+    smallest = np.argpartition(values, k)[:k]
+    return smallest[np.argsort(values[smallest])]
+
+
 def get_unit_similarities(
     cluster_id,
     st_1,
@@ -46,69 +223,65 @@ def get_unit_similarities(
     shifts_align=[0],
     order_by="similarity",
     normalize_agreement_by="both",
+    template_cache=None,
+    similarity_metric="maxabs",
+    n_jobs=1,
 ):
-    waveforms1, _ = read_waveforms(st_1, raw_data_bin, geom_array.shape[0])
-    template1 = np.median(waveforms1, axis=0)
+    closest_clusters = np.asarray(closest_clusters)
+    closest_clusters = closest_clusters[
+        np.isin(closest_clusters, sorting.get_unit_ids())
+    ]
+    unit_spike_train = spike_train_getter(sorting)
+    spike_trains = [unit_spike_train(u) for u in closest_clusters]
+    template1 = median_template(
+        st_1, raw_data_bin, geom_array.shape[0], template_cache
+    )
     original_template = np.copy(template1)
-    max_ptp_channel = template1.ptp(0).argmax()
-    channel_range = (
-        max(max_ptp_channel - num_channels_similarity // 2, 0),
-        max_ptp_channel + num_channels_similarity // 2,
+    template1, channel_range, _ = template_channel_window(
+        template1, num_channels_similarity
+    )
+    # the neighbors are only compared on this unit's window, so only
+    # those channels are read
+    templates2 = median_templates(
+        spike_trains,
+        raw_data_bin,
+        geom_array.shape[0],
+        template_cache,
+        n_jobs=n_jobs,
+        channels=np.arange(*channel_range),
     )
-    template1 = template1[:, channel_range[0] : channel_range[1]]
-
-    similarities = []
-    agreements = []
-    templates = []
-    shifts = []
-    for closest_cluster in closest_clusters:
-        if closest_cluster in sorting.get_unit_ids():
-            st_2 = sorting.get_unit_spike_train(closest_cluster)
-            waveforms2, _ = read_waveforms(
-                st_2, raw_data_bin, geom_array.shape[0]
-            )
-            template2 = np.median(waveforms2, axis=0)[
-                :, channel_range[0] : channel_range[1]
-            ]
-            similarity, shift = compute_shifted_similarity(
-                template1, template2, shifts_align
-            )
-            shifts.append(shift)
-            similarities.append(similarity)
-            # similarities.append(similarity[0][0])
-            (
-                ind_st1,
-                ind_st2,
-                not_match_ind_st1,
-                not_match_ind_st2,
-            ) = compute_spiketrain_agreement(st_1, st_2, delta_frames=12)
-            if normalize_agreement_by == "both":
-                agreement = len(ind_st1) / (
-                    len(st_1) + len(st_2) - len(ind_st1)
-                )
-            elif normalize_agreement_by == "first":
-                agreement = len(ind_st1) / len(st_1)
-            elif normalize_agreement_by == "second":
-                agreement = len(ind_st1) / len(st_2)
-            else:
-                raise ValueError(
-                    "normalize_agreement_by must be both, first, or second"
-                )
-            agreements.append(agreement)
-            templates.append(template2)
-    agreements = np.asarray(agreements).round(2)
-    similarities = np.asarray(similarities).round(2)
-    closest_clusters = np.asarray(closest_clusters)
-    shifts = np.asarray(shifts)
-    templates = np.asarray(templates)
+
+    # comparisons run in float32 whatever the recording's dtype. float16
+    # would not resolve the 0.01 rounding of the similarities below.
+    template1 = template1.astype(np.float32, copy=False)
+    templates = np.empty(
+        (len(closest_clusters), *template1.shape), dtype=np.float32
+    )
+    for i, template2 in enumerate(templates2):
+        templates[i] = template2
+    n_matched = matched_spike_counts(st_1, spike_trains, delta_frames=12)
+    n_2 = np.array([len(st_2) for st_2 in spike_trains])
+    if normalize_agreement_by == "both":
+        agreements = n_matched / (len(st_1) + n_2 - n_matched)
+    elif normalize_agreement_by == "first":
+        agreements = n_matched / len(st_1)
+    elif normalize_agreement_by == "second":
+        agreements = n_matched / n_2
+    else:
+        raise ValueError(
+            "normalize_agreement_by must be both, first, or second"
+        )
+    similarities, shifts = compute_shifted_similarities(
+        template1, templates, shifts_align, metric=similarity_metric
+    )
+    agreements = agreements.round(2)
+    similarities = similarities.round(2)
 
     # compute most similar units (with template similarity or spike train agreement)
     if order_by == "similarity":
-        most_similar_idxs = np.argsort(
-            similarities
-        )  # np.flip(np.argsort(similarities))
+        most_similar_idxs = smallest_k_order(similarities, num_close_clusters)
     elif order_by == "agreement":
-        most_similar_idxs = np.flip(np.argsort(agreements))
+        most_similar_idxs = smallest_k_order(-agreements, num_close_clusters)
 
     agreements = agreements[most_similar_idxs]
     similarities = similarities[most_similar_idxs]
@@ -126,38 +299,150 @@ def get_unit_similarities(
     )
 
 
+def closest_spike_indices(st, times):
+    """Index of the spike in `st` closest to each of `times`
+
+    Same as `[np.abs(st - t).argmin() for t in times]`, ties included,
+    but by binary search rather than a scan per time.
+    """
+    order = np.argsort(st, kind="stable")
+    st_sorted = st[order]
+    pos = np.searchsorted(st_sorted, times).clip(1, len(st) - 1)
+    left = st_sorted[pos - 1]
+    right = st_sorted[pos]
+    dleft = np.abs(times - left)
+    dright = np.abs(right - times)
+    # first occurrences, as argmin would find them
+    ileft = order[np.searchsorted(st_sorted, left)]
+    iright = order[np.searchsorted(st_sorted, right)]
+    return np.where(
+        dleft == dright,
+        np.minimum(ileft, iright),
+        np.where(dleft < dright, ileft, iright),
+    )
+
+
+def closest_channels_by_depth(geom, depths):
+    """Channel whose z position in `geom` is closest to each of `depths`
+
+    Same as `[np.abs(d - geom[:, 1]).argmin() for d in depths]`.
+    """
+    return closest_spike_indices(geom[:, 1], np.asarray(depths))
+
+
+def unmatched_indices(n, ind):
+    """Sorted indices in range(n) which are not in `ind`
+
+    `ind` may repeat entries (several matches can share a closest spike),
+    so it is not passed to setdiff1d as unique.
+    """
+    return np.setdiff1d(np.arange(n), ind)
+
+
+@numba.njit(nogil=True)
+def _matched_positions(times_sorted, membership_sorted, delta_frames):
+    """Positions of matched spikes in a merged, sorted pair of spike trains
+
+    Neighbors within `delta_frames` from different trains are matches, and
+    runs of such neighbors are reduced to one position per run. This is
+    one pass over the merged train, without the diffs/mask temporaries.
+    """
+    out = np.empty(max(len(times_sorted) - 1, 0), dtype=np.int64)
+    n = 0
+    last = -1
+    for i in range(len(times_sorted) - 1):
+        if (
+            times_sorted[i + 1] - times_sorted[i] <= delta_frames
+            and membership_sorted[i] != membership_sorted[i + 1]
+        ):
+            # a gap since the last match ends that run
+            if last >= 0 and i != last + 1:
+                out[n] = last + 1
+                n += 1
+            last = i
+    if last >= 0:
+        out[n] = last
+        n += 1
+    return out[:n]
+
+
+@numba.njit(nogil=True, parallel=True)
+def _matched_run_counts(st_1, trains, offsets, delta_frames):
+    """Number of matches between sorted st_1 and each of several trains
+
+    The trains are sorted and concatenated, with train j at
+    trains[offsets[j]:offsets[j + 1]]. Each is merged with st_1 in
+    one walk and its matches are counted as in _matched_positions,
+    which is the length of compute_spiketrain_agreement's ind_st1.
+    """
+    counts = np.zeros(len(offsets) - 1, dtype=np.int64)
+    for j in numba.prange(len(offsets) - 1):
+        st_2 = trains[offsets[j] : offsets[j + 1]]
+        n = len(st_1) + len(st_2)
+        i1 = i2 = 0
+        prev_time = prev_member = 0
+        # position of the last matched pair
+        last = -2
+        count = 0
+        for i in range(n):
+            if i2 >= len(st_2) or (i1 < len(st_1) and st_1[i1] <= st_2[i2]):
+                time = st_1[i1]
+                member = 1
+                i1 += 1
+            else:
+                time = st_2[i2]
+                member = 2
+                i2 += 1
+            if (
+                i > 0
+                and time - prev_time <= delta_frames
+                and member != prev_member
+            ):
+                # runs of consecutive matched pairs count once
+                if last != i - 2:
+                    count += 1
+                last = i - 1
+            prev_time = time
+            prev_member = member
+        counts[j] = count
+    return counts
+
+
+def matched_spike_counts(st_1, spike_trains, delta_frames=12):
+    """Length of compute_spiketrain_agreement's ind_st1 for each train
+
+    Counts st_1's matches with all of `spike_trains` in one parallel
+    pass, rather than sorting each pair's merged train in turn.
+    """
+    st_1 = np.sort(st_1).astype(np.int64)
+    offsets = np.zeros(len(spike_trains) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(st) for st in spike_trains])
+    trains = np.zeros(offsets[-1], dtype=np.int64)
+    for st, start, end in zip(spike_trains, offsets[:-1], offsets[1:]):
+        trains[start:end] = np.sort(st)
+    return _matched_run_counts(st_1, trains, offsets, delta_frames)
+
+
 def compute_spiketrain_agreement(st_1, st_2, delta_frames=12):
     # create figure for each match
     times_concat = np.concatenate((st_1, st_2))
     membership = np.concatenate(
         (np.ones(st_1.shape) * 1, np.ones(st_2.shape) * 2)
     )
-    indices = times_concat.argsort()
+    indices = times_concat.argsort(kind="stable")
     times_concat_sorted = times_concat[indices]
     membership_sorted = membership[indices]
-    diffs = times_concat_sorted[1:] - times_concat_sorted[:-1]
-    inds = np.flatnonzero(
-        (diffs <= delta_frames)
-        & (membership_sorted[:-1] != membership_sorted[1:])
+    inds2 = _matched_positions(
+        times_concat_sorted, membership_sorted, delta_frames
     )
 
-    if len(inds) > 0:
-        inds2 = inds[np.where(inds[:-1] + 1 != inds[1:])[0]] + 1
-        inds2 = np.concatenate((inds2, [inds[-1]]))
+    if len(inds2) > 0:
         times_matched = times_concat_sorted[inds2]
         # # find and label closest spikes
-        ind_st1 = np.array(
-            [np.abs(st_1 - tm).argmin() for tm in times_matched]
-        )
-        ind_st2 = np.array(
-            [np.abs(st_2 - tm).argmin() for tm in times_matched]
-        )
-        not_match_ind_st1 = np.ones(st_1.shape[0], bool)
-        not_match_ind_st1[ind_st1] = False
-        not_match_ind_st1 = np.where(not_match_ind_st1)[0]
-        not_match_ind_st2 = np.ones(st_2.shape[0], bool)
-        not_match_ind_st2[ind_st2] = False
-        not_match_ind_st2 = np.where(not_match_ind_st2)[0]
+        ind_st1 = closest_spike_indices(st_1, times_matched)
+        ind_st2 = closest_spike_indices(st_2, times_matched)
+        not_match_ind_st1 = unmatched_indices(st_1.shape[0], ind_st1)
+        not_match_ind_st2 = unmatched_indices(st_2.shape[0], ind_st2)
     else:
         ind_st1 = np.array([], dtype=int)
         ind_st2 = np.array([], dtype=int)
@@ -179,32 +464,20 @@ def get_agreement_indices(
     membership = np.concatenate(
         (np.full_like(st_1, 1), np.full_like(mapped_st, 2))
     )
-    indices = times_concat.argsort()
+    indices = times_concat.argsort(kind="stable")
     times_concat_sorted = times_concat[indices]
     membership_sorted = membership[indices]
-    diffs = np.diff(times_concat_sorted)
-    inds = np.flatnonzero(
-        (diffs <= delta_frames)
-        & (membership_sorted[:-1] != membership_sorted[1:])
+    inds2 = _matched_positions(
+        times_concat_sorted, membership_sorted, delta_frames
     )
 
-    if len(inds) > 0:
-        inds2 = inds[np.where(inds[:-1] + 1 != inds[1:])[0]] + 1
-        inds2 = np.concatenate((inds2, [inds[-1]]))
+    if len(inds2) > 0:
         times_matched = times_concat_sorted[inds2]
         # # find and label closest spikes
-        ind_st1 = np.array(
-            [np.abs(st_1 - tm).argmin() for tm in times_matched]
-        )
-        ind_st2 = np.array(
-            [np.abs(mapped_st - tm).argmin() for tm in times_matched]
-        )
-        not_match_ind_st1 = np.ones(st_1.shape[0], bool)
-        not_match_ind_st1[ind_st1] = False
-        not_match_ind_st1 = np.where(not_match_ind_st1)[0]
-        not_match_ind_st2 = np.ones(mapped_st.shape[0], bool)
-        not_match_ind_st2[ind_st2] = False
-        not_match_ind_st2 = np.where(not_match_ind_st2)[0]
+        ind_st1 = closest_spike_indices(st_1, times_matched)
+        ind_st2 = closest_spike_indices(mapped_st, times_matched)
+        not_match_ind_st1 = unmatched_indices(st_1.shape[0], ind_st1)
+        not_match_ind_st2 = unmatched_indices(mapped_st.shape[0], ind_st2)
 
     return (
         ind_st1,
@@ -223,19 +496,19 @@ def remove_duplicate_units(clusterer, spike_frames, maxptps):
         sorting, sorting, match_score=0.1, chance_score=0.1
     )
 
+    label_index = get_label_index(clusterer.labels_)
     remove_ids = set()
     for cluster_id in sorting.get_unit_ids():
         possible_matches = cmp_self.possible_match_12[cluster_id]
         if len(possible_matches) > 1:
             mean_ptp_matches = [
-                np.mean(maxptps[clusterer.labels_ == cluster_id])
+                np.mean(maxptps[label_index[cluster_id]])
                 for cluster_id in possible_matches
             ]
             remove_ids.add(possible_matches[np.argmin(mean_ptp_matches)])
 
     for remove_id in remove_ids:
-        remove_id_indices = np.where(clusterer.labels_ == remove_id)
-        clusterer.labels_[remove_id_indices] = -1
+        clusterer.labels_[label_index[remove_id]] = -1
 
     # make sequential
     clusterer.labels_ = make_labels_contiguous(clusterer.labels_)
@@ -257,6 +530,7 @@ def remove_duplicate_spikes(
     cmp_self = compare_two_sorters(
         sorting, sorting, match_score=0.1, chance_score=0.1
     )
+    label_index = get_label_index(clusterer.labels_)
     removed_cluster_ids = set()
     remove_spikes = []
     for cluster_id in tqdm(sorting.get_unit_ids(), desc="Remove pair dups"):
@@ -274,7 +548,7 @@ def remove_duplicate_spikes(
                 st_1, st_2, delta_frames=frames_dedup
             )
             mean_ptp_matches = [
-                maxptps[clusterer.labels_ == cluster_id].mean()
+                maxptps[label_index[cluster_id]].mean()
                 for cluster_id in possible_matches
             ]
             which = np.argmin(mean_ptp_matches)
@@ -296,8 +570,9 @@ def remove_duplicate_spikes(
 
     remove_indices_list = []
     for cluster_id, _, spike_indices in remove_spikes:
-        in_unit = np.flatnonzero(clusterer.labels_ == cluster_id)
-        remove_indices = in_unit[spike_indices]
+        # each unit is removed from at most once, so its indices from
+        # before any removals are still its indices here
+        remove_indices = label_index[cluster_id][spike_indices]
         clusterer.labels_[remove_indices] = -1
         remove_indices_list.append(remove_indices)
 
@@ -716,6 +991,18 @@ def relabel_by_depth(clusterer, cluster_centers):
     return clusterer
 
 
+def get_label_index(labels):
+    """Map each label to the (sorted) indices of the spikes with that label
+
+    This is one stable argsort, for callers looking up many units' spikes,
+    rather than a full `labels == unit` scan per unit.
+    """
+    order = np.argsort(labels, kind="stable")
+    units, starts = np.unique(labels[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    return {u: order[s:e] for u, s, e in zip(units, starts, ends)}
+
+
 def get_closest_clusters_hdbscan(
     cluster_id, cluster_centers, num_close_clusters=2
 ):
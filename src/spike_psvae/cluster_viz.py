@@ -1,4 +1,7 @@
 # %%
+from functools import lru_cache
+from pathlib import Path
+
 import colorcet as cc
 import matplotlib
 import matplotlib.gridspec as gridspec
@@ -6,19 +9,23 @@ import matplotlib.pyplot as plt
 import matplotlib.transforms as transforms
 import numpy as np
 # import seaborn as sns
+from matplotlib.collections import LineCollection
 from matplotlib.patches import Ellipse
 # %%
-# matplotlib.use('Agg')
+from joblib import Parallel, delayed
 from matplotlib_venn import venn2
 from sklearn.decomposition import PCA
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from spike_psvae.cluster_utils import (compute_spiketrain_agreement,
                                        get_closest_clusters_hdbscan,
                                        get_closest_clusters_kilosort,
-                                       get_unit_similarities)
+                                       get_label_index,
+                                       get_unit_similarities,
+                                       spike_train_getter,
+                                       template_channel_window)
 from spike_psvae.denoise import denoise_wf_nn_tmp_single_channel
 # %%
-from spike_psvae.spikeio import read_waveforms
+from spike_psvae.spikeio import read_waveforms, read_waveforms_mean
 from spikeinterface.comparison import compare_two_sorters
 from spikeinterface.extractors import NumpySorting
 from spikeinterface.postprocessing import compute_correlograms
@@ -781,6 +788,120 @@ def array_scatter_with_pcs(
     return fig, axes
 
 
+# %%
+@lru_cache(maxsize=8)
+def _probe_rows(z_bytes):
+    return np.unique(np.frombuffer(z_bytes), return_inverse=True)
+
+
+def probe_rows(geom):
+    """Sorted unique row depths of the probe, and each channel's row index
+
+    Cached per probe geometry, since plots are drawn unit after unit on
+    the same probe. The returned arrays are shared, so don't modify them.
+    """
+    z = np.ascontiguousarray(geom[:, 1], dtype=np.float64)
+    return _probe_rows(z.tobytes())
+
+
+def mode_channel(channels):
+    """Most common channel, breaking ties toward the lowest index like np.unique
+
+    Channels are small non-negative integers, so one bincount pass finds
+    the mode without the sort that np.unique(return_counts=True) does.
+    """
+    return int(np.bincount(np.asarray(channels, dtype=np.int64)).argmax())
+
+
+def get_channels_plot(geom, main_channels, num_rows=3):
+    """Channels within `num_rows` rows of the most common main channel
+
+    Returns these channels along with the sorted unique z positions of
+    the probe's rows.
+    """
+    z_uniq, z_ids = probe_rows(geom)
+    mcid = z_ids[mode_channel(main_channels)]
+    channels_plot = np.flatnonzero(
+        (z_ids >= mcid - num_rows) & (z_ids <= mcid + num_rows)
+    )
+    return channels_plot, z_uniq
+
+
+# %%
+def ensure_memmap(waveforms, shape=None, dtype=np.float32):
+    """Open waveforms given by path as a read-only memmap, else pass through
+
+    Plots index a few hundred spikes out of these arrays, so reading them
+    through a memmap pages in just those spikes rather than loading all
+    of them. .npy files carry their own shape and dtype. Raw binaries
+    need `shape` (and `dtype`, if not float32).
+    """
+    if not isinstance(waveforms, (str, Path)):
+        return waveforms
+    if Path(waveforms).suffix == ".npy":
+        return np.load(waveforms, mmap_mode="r")
+    return np.memmap(waveforms, dtype=dtype, mode="r", shape=shape)
+
+
+def read_neighborhoods(spike_times, bin_file, geom, first_chans, num_channels):
+    """Read spikes on the `num_channels` channels from each one's first channel
+
+    Only these channels are read, rather than reading the full probe
+    and slicing. Channels past the probe's edge come back as NaN.
+    """
+    channels = np.asarray(first_chans).astype(int)[:, None] + np.arange(
+        num_channels
+    )
+    return read_waveforms(
+        spike_times,
+        bin_file,
+        geom.shape[0],
+        channels=channels,
+        spike_length_samples=121,
+    )[0]
+
+
+# %%
+def waveform_segments(
+    waveforms,
+    first_chans,
+    channels_plot,
+    geom,
+    times_plot,
+    t_range,
+    scale,
+    num_spikes_plot,
+    x_shift=0,
+):
+    """Line segments placing each spike's traces at their channels' positions
+
+    Returns a (n_traces, n_times, 2) array of segments for a LineCollection,
+    covering the traces of the first `num_spikes_plot` spikes which land
+    on `channels_plot`, along with the channel and spike of each trace.
+    `x_shift` may be a scalar or one shift per spike.
+    """
+    n = min(len(waveforms), num_spikes_plot)
+    chans = first_chans[:n].astype(int)[:, None] + np.arange(waveforms.shape[2])
+    # padded so that waveforms hanging off the top of the probe index it
+    plot_mask = np.zeros(len(geom) + waveforms.shape[2], dtype=bool)
+    plot_mask[channels_plot] = True
+    ii, kk = np.nonzero(plot_mask[chans])
+    chans = chans[ii, kk]
+    # float32 is far finer than a pixel here, while float16 would round
+    # to whole microns on deep channels
+    traces = waveforms[ii, t_range[0] : t_range[1], kk].astype(np.float32)
+    traces *= scale
+    # x offsets are the same for every trace on a channel, so they are
+    # broadcast rather than rebuilt for each one
+    geom = geom.astype(np.float32)
+    x_shift = np.asarray(x_shift, dtype=np.float32)
+    if x_shift.ndim:
+        x_shift = x_shift[ii, None]
+    xs = geom[chans, 0, None] + (times_plot.astype(np.float32) + x_shift)
+    ys = traces + geom[chans, 1, None]
+    return np.stack(np.broadcast_arrays(xs, ys), axis=-1), chans, ii
+
+
 # %%
 def plot_waveforms_geom_unit(
     geom,
@@ -806,6 +927,11 @@ def plot_waveforms_geom_unit(
     ax=None,
     color="blue",
 ):
+    """Plot a unit's waveforms at their positions on the probe
+
+    `color` and `h_shift` may also be given per spike, to draw several
+    groups of spikes in one call. (Not with `do_mean`.)
+    """
     ax = ax or plt.gca()
     some_in_cluster = np.random.default_rng(0).choice(
         list(range(len(spike_times))),
@@ -815,17 +941,16 @@ def plot_waveforms_geom_unit(
     first_chans_cluster = first_chans_cluster[some_in_cluster]
     mcs_abs_cluster = mcs_abs_cluster[some_in_cluster]
     spike_times = spike_times[some_in_cluster]
+    per_spike_color = not matplotlib.colors.is_color_like(color)
+    if per_spike_color:
+        color = np.asarray(color)[some_in_cluster]
+    if np.ndim(h_shift):
+        h_shift = np.asarray(h_shift)[some_in_cluster]
+    if do_mean and (per_spike_color or np.ndim(h_shift)):
+        raise ValueError("do_mean needs a single color and h_shift.")
 
     # what channels will we plot?
-    vals, counts = np.unique(
-        mcs_abs_cluster,
-        return_counts=True,
-    )
-    z_uniq, z_ids = np.unique(geom[:, 1], return_inverse=True)
-    mcid = z_ids[vals[counts.argmax()]]
-    channels_plot = np.flatnonzero(
-        (z_ids >= mcid - num_rows) & (z_ids <= mcid + num_rows)
-    )
+    channels_plot, z_uniq = get_channels_plot(geom, mcs_abs_cluster, num_rows)
 
     # how to scale things?
     if scale is None:
@@ -848,19 +973,9 @@ def plot_waveforms_geom_unit(
 
     if raw_bin is not None:
         # raw data and spike times passed in
-        waveforms_read = read_waveforms(
-            spike_times, raw_bin, geom.shape[0], spike_length_samples=121
-        )[0]
-        waveforms = []
-        for i, waveform in enumerate(waveforms_read):
-            waveforms.append(
-                waveform[
-                    :,
-                    int(first_chans_cluster[i]) : int(first_chans_cluster[i])
-                    + num_channels,
-                ].copy()
-            )
-        waveforms = np.asarray(waveforms)
+        waveforms = read_neighborhoods(
+            spike_times, raw_bin, geom, first_chans_cluster, num_channels
+        )
     elif waveforms_cluster is None:
         # no raw data and no waveforms passed - bad!
         raise ValueError("need to input raw_bin or waveforms")
@@ -869,21 +984,9 @@ def plot_waveforms_geom_unit(
         waveforms = waveforms_cluster[some_in_cluster]
         if residual_bin is not None:
             # add residuals
-            residuals_read = read_waveforms(
-                spike_times, residual_bin, geom.shape[0], spike_length_samples=121
-            )[0]
-            residuals = []
-            for i, residual in enumerate(residuals_read):
-                residuals.append(
-                    residual[
-                        :,
-                        int(first_chans_cluster[i]) : int(
-                            first_chans_cluster[i]
-                        )
-                        + num_channels,
-                    ]
-                )
-            residuals = np.asarray(residuals)
+            residuals = read_neighborhoods(
+                spike_times, residual_bin, geom, first_chans_cluster, num_channels
+            )
             waveforms = waveforms + residuals
     if denoiser is not None and device is not None:
         # denoise waveforms
@@ -893,30 +996,25 @@ def plot_waveforms_geom_unit(
     if do_mean:
         # plot the mean rather than the invididual spikes
         waveforms = np.expand_dims(np.mean(waveforms, axis=0), 0)
-    draw_lines = []
-    for i in range(min(len(waveforms), num_spikes_plot)):
-        for k, channel in enumerate(
-            range(
-                int(first_chans_cluster[i]),
-                int(first_chans_cluster[i]) + waveforms.shape[2],
-            )
-        ):
-            if channel in channels_plot:
-                trace = waveforms[
-                    i,
-                    t_range[0] : t_range[1],
-                    k,
-                ]
-            else:
-                continue
-            waveform = trace * scale
-            draw_lines.append(geom[channel, 0] + times_plot + h_shift)
-            draw_lines.append(waveform + geom[channel, 1])
-    ax.plot(
-        *draw_lines,
-        alpha=alpha,
-        c=color,
+    segments, _, spikes = waveform_segments(
+        waveforms,
+        first_chans_cluster,
+        channels_plot,
+        geom,
+        times_plot,
+        t_range,
+        scale,
+        num_spikes_plot,
+        x_shift=h_shift,
+    )
+    if per_spike_color:
+        color = list(color[spikes])
+    # one collection for all of the traces, rather than a Line2D each,
+    # rasterized so that vector (pdf/svg) output holds one image of them
+    ax.add_collection(
+        LineCollection(segments, colors=color, alpha=alpha, rasterized=True)
     )
+    ax.autoscale_view()
 
 
 # %%
@@ -943,25 +1041,30 @@ def plot_waveforms_geom(
     do_mean=False,
     scale=None,
     ax=None,
+    label_index=None,
+    read_cache=None,
 ):
     ax = ax or plt.gca()
+    # when plotting many units, pass label_index (cluster_utils.get_label_index)
+    # to look up each unit's spikes rather than scanning labels for them.
+    # similarly, a dict passed as read_cache keeps each unit's raw/residual
+    # reads, so units plotted again (as another unit's neighbor, or in
+    # another panel) are not read from disk again. reads are keyed on the
+    # spike times and channels actually read, so one cache can be shared
+    # across labelings.
+    cluster_ids = (main_cluster_id, *neighbor_clusters)
+    if label_index is None:
+        label_index = {u: np.flatnonzero(labels == u) for u in cluster_ids}
+    waveforms = ensure_memmap(waveforms)
 
     # what channels will we plot?
-    vals, counts = np.unique(
-        spike_index[np.flatnonzero(labels == main_cluster_id), 1],
-        return_counts=True,
-    )
-    z_uniq, z_ids = np.unique(geom[:, 1], return_inverse=True)
-    mcid = z_ids[vals[counts.argmax()]]
-    channels_plot = np.flatnonzero(
-        (z_ids >= mcid - num_rows) & (z_ids <= mcid + num_rows)
+    channels_plot, z_uniq = get_channels_plot(
+        geom, spike_index[label_index[main_cluster_id], 1], num_rows
     )
 
     # how to scale things?
     if scale is None:
-        all_max_ptp = maxptps[
-            np.isin(labels, (*neighbor_clusters, main_cluster_id))
-        ].max()
+        all_max_ptp = max(maxptps[label_index[u]].max() for u in cluster_ids)
         scale = (z_uniq[1] - z_uniq[0]) / max(7, all_max_ptp)
 
     times_plot = np.arange(t_range[0] - 42, t_range[1] - 42).astype(float)
@@ -975,14 +1078,12 @@ def plot_waveforms_geom(
             ax.annotate(c, (geom[c, 0], geom[c, 1]))
 
     # plot each cluster
-    for j, cluster_id in reversed(
-        list(enumerate((main_cluster_id, *neighbor_clusters)))
-    ):
+    for j, cluster_id in reversed(list(enumerate(cluster_ids))):
         if colors is None:
             color = get_ccolor(cluster_id)
         else:
             color = colors[j]
-        in_cluster = np.flatnonzero(labels == cluster_id)
+        in_cluster = label_index[cluster_id]
         some_in_cluster = np.random.default_rng(0).choice(
             in_cluster,
             replace=False,
@@ -991,23 +1092,26 @@ def plot_waveforms_geom(
         some_in_cluster.sort()
         first_chans_cluster = firstchans[some_in_cluster]
         spike_times = spike_index[:, 0][some_in_cluster]
+
+        def read(bin_file):
+            key = (
+                str(bin_file),
+                spike_times.tobytes(),
+                first_chans_cluster.tobytes(),
+                num_channels,
+            )
+            if read_cache is not None and key in read_cache:
+                return read_cache[key]
+            wfs = read_neighborhoods(
+                spike_times, bin_file, geom, first_chans_cluster, num_channels
+            )
+            if read_cache is not None:
+                read_cache[key] = wfs
+            return wfs
+
         if raw_bin is not None:
             # raw data and spike times passed in
-            waveforms_read = read_waveforms(
-                spike_times, raw_bin, geom.shape[0], spike_length_samples=121
-            )[0]
-            waveforms_in_cluster = []
-            for i, waveform in enumerate(waveforms_read):
-                waveforms_in_cluster.append(
-                    waveform[
-                        :,
-                        int(first_chans_cluster[i]) : int(
-                            first_chans_cluster[i]
-                        )
-                        + num_channels,
-                    ].copy()
-                )
-            waveforms_in_cluster = np.asarray(waveforms_in_cluster)
+            waveforms_in_cluster = read(raw_bin)
         elif waveforms is None:
             # no raw data and no waveforms passed - bad!
             raise ValueError("need to input raw_bin or waveforms")
@@ -1016,21 +1120,7 @@ def plot_waveforms_geom(
             waveforms_in_cluster = waveforms[some_in_cluster]
             if residual_bin is not None:
                 # add residuals
-                residuals_read = read_waveforms(
-                    spike_times, residual_bin, geom.shape[0], spike_length_samples=121
-                )[0]
-                residuals = []
-                for i, residual in enumerate(residuals_read):
-                    residuals.append(
-                        residual[
-                            :,
-                            int(first_chans_cluster[i]) : int(
-                                first_chans_cluster[i]
-                            )
-                            + num_channels,
-                        ]
-                    )
-                residuals = np.asarray(residuals)
+                residuals = read(residual_bin)
                 waveforms_in_cluster = waveforms_in_cluster + residuals
         if denoiser is not None and device is not None:
             # denoise waveforms
@@ -1042,36 +1132,25 @@ def plot_waveforms_geom(
             waveforms_in_cluster = np.expand_dims(
                 np.mean(waveforms_in_cluster, axis=0), 0
             )
-        vertical_lines = set()
-        draw_lines = []
-        for i in range(min(len(waveforms_in_cluster), num_spikes_plot)):
-            for k, channel in enumerate(
-                range(
-                    int(first_chans_cluster[i]),
-                    int(first_chans_cluster[i])
-                    + waveforms_in_cluster.shape[2],
-                )
-            ):
-                if channel in channels_plot:
-                    trace = waveforms_in_cluster[
-                        i,
-                        t_range[0] : t_range[1],
-                        k,
-                    ]
-                else:
-                    continue
-                waveform = trace * scale
-                draw_lines.append(geom[channel, 0] + times_plot)
-                draw_lines.append(waveform + geom[channel, 1])
-                max_vert_line = geom[channel, 0]
-                if max_vert_line not in vertical_lines:
-                    vertical_lines.add(max_vert_line)
-                    ax.axvline(max_vert_line, linestyle="--")
-        ax.plot(
-            *draw_lines,
-            alpha=alpha,
-            c=color,
+        segments, chans, _ = waveform_segments(
+            waveforms_in_cluster,
+            first_chans_cluster,
+            channels_plot,
+            geom,
+            times_plot,
+            t_range,
+            scale,
+            num_spikes_plot,
+        )
+        for x in np.unique(geom[chans, 0]):
+            ax.axvline(x, linestyle="--")
+        # one collection for all of the traces, rather than a Line2D each
+        ax.add_collection(
+            LineCollection(
+                segments, colors=color, alpha=alpha, rasterized=True
+            )
         )
+        ax.autoscale_view()
 
 
 # %%
@@ -1104,17 +1183,13 @@ def plot_venn_agreement(
 # %%
 def plot_self_agreement(labels, spike_times, fig=None):
     # matplotlib.rcParams.update({'font.size': 22})
-    indices_list = []
-    labels_list = []
-    for cluster_id in np.unique(labels):
-        label_ids = np.where(labels == cluster_id)
-        indices = spike_times[label_ids]
-        num_labels = label_ids[0].shape[0]
-        indices_list.append(indices)
-        labels_list.append((np.zeros(num_labels) + cluster_id).astype("int"))
+    # spikes grouped by unit, from one argsort rather than a scan per unit
+    label_index = get_label_index(labels)
     sorting = NumpySorting.from_times_labels(
-        times_list=np.concatenate(indices_list),
-        labels_list=np.concatenate(labels_list),
+        times_list=np.concatenate([spike_times[ix] for ix in label_index.values()]),
+        labels_list=np.concatenate(
+            [np.full(len(ix), u, dtype=int) for u, ix in label_index.items()]
+        ),
         sampling_frequency=30000,
     )
     sorting_comparison = compare_two_sorters(sorting, sorting)
@@ -1177,13 +1252,26 @@ def plot_single_unit_summary(
     t_range=(30, 90),
     plot_all_points=False,
     num_channels=40,
+    label_index=None,
+    figsize=(24 + 18 * 3, 36),
+    dpi=100,
+    read_cache=None,
 ):
     matplotlib.rcParams.update({"font.size": 30})
-    label_indices = np.where(labels == cluster_id)
+    wfs_full_denoise = ensure_memmap(wfs_full_denoise)
+    wfs_subtracted = ensure_memmap(wfs_subtracted)
 
     closest_clusters = get_closest_clusters_hdbscan(
         cluster_id, cluster_centers, num_close_clusters=2
     )
+    # each unit's spikes, looked up once. when summarizing many units,
+    # pass label_index (cluster_utils.get_label_index) to skip the scans
+    if label_index is None:
+        label_index = {
+            u: np.flatnonzero(labels == u) for u in (cluster_id, *closest_clusters)
+        }
+    label_indices = label_index[cluster_id]
+    spike_train = spike_index[label_indices, 0]
     # scales = (1,10,1,15,30) #predefined scales for each feature
     features = np.concatenate(
         (
@@ -1194,10 +1282,10 @@ def plot_single_unit_summary(
         axis=1,
     )
 
-    close_labels_indices = np.where(
-        (labels == cluster_id)
-        | (labels == closest_clusters[0])
-        | (labels == closest_clusters[1])
+    close_labels_indices = np.unique(
+        np.concatenate(
+            [label_index[u] for u in (cluster_id, *closest_clusters[:2])]
+        )
     )
     all_cluster_features_close = features[close_labels_indices]
     all_labels_close = labels[close_labels_indices]
@@ -1230,7 +1318,7 @@ def plot_single_unit_summary(
         plot_labels = all_labels_close
         cm_plot = np.clip(maxptps, 3, 15)[close_labels_indices]
 
-    fig = plt.figure(figsize=(24 + 18 * 3, 36))
+    fig = plt.figure(figsize=figsize, dpi=dpi)
     grid = (6, 6)
     ax_raw = plt.subplot2grid(grid, (0, 0), rowspan=6)
     ax_cleaned = plt.subplot2grid(grid, (0, 1), rowspan=6)
@@ -1278,20 +1366,20 @@ def plot_single_unit_summary(
     ax.set_xlim(x_cutoff)
 
     ax = ax_ptp
-    ptps_cluster = features[:, 2][label_indices]
-    spike_train_s = spike_index[:, 0][label_indices] / 30000
+    features_cluster = features[label_indices]
+    ptps_cluster = features_cluster[:, 2]
+    spike_train_s = spike_train / 30000
     ax.plot(spike_train_s, ptps_cluster)
     ax.set_ylabel("ptp")
     ax.set_xlabel("seconds")
 
     ax = ax_ptp_z
-    zs_cluster = features[:, 1][label_indices]
+    zs_cluster = features_cluster[:, 1]
     ax.scatter(zs_cluster, ptps_cluster)
     ax.set_xlabel("zs")
     ax.set_ylabel("ptps")
 
     ax = ax_isi
-    spike_train = spike_index[:, 0][label_indices]
     ax.set_xlabel("ms")
     spike_train_diff = np.diff(spike_train) / 30000
     spike_train_diff = spike_train_diff[np.where(spike_train_diff < 0.01)]
@@ -1301,36 +1389,37 @@ def plot_single_unit_summary(
     ax.set_title("isis")
     ax.set_xlim([-1, 10])
 
+    # one sorting holding this unit (label 0) and its neighbors (1, 2, ...)
+    # gives all of the cross-correlograms in a single pass
     axes = [ax_xcorr1, ax_xcorr2]
+    xcorr_trains = [spike_train] + [
+        spike_index[label_index[u], 0] for u in closest_clusters
+    ]
+    sorting = NumpySorting.from_times_labels(
+        times_list=np.concatenate(xcorr_trains),
+        labels_list=np.repeat(
+            np.arange(len(xcorr_trains)), [len(st) for st in xcorr_trains]
+        ),
+        sampling_frequency=30000,
+    )
+    bin_ms = 1.0
+    correlograms, bins = compute_correlograms(
+        sorting, symmetrize=True, window_ms=10.0, bin_ms=bin_ms
+    )
     for i, cluster_isi_id in enumerate(closest_clusters):
-        spike_train_2 = spike_index[:, 0][
-            np.flatnonzero(labels == cluster_isi_id)
-        ]
-        sorting = NumpySorting.from_times_labels(
-            times_list=np.concatenate((spike_train, spike_train_2)),
-            labels_list=np.concatenate(
-                (
-                    np.zeros(spike_train.shape[0]).astype("int"),
-                    np.zeros(spike_train_2.shape[0]).astype("int") + 1,
-                )
-            ),
-            sampling_frequency=30000,
+        axes[i].bar(
+            bins[1:], correlograms[0][i + 1], width=bin_ms, align="center"
         )
-        bin_ms = 1.0
-        correlograms, bins = compute_correlograms(
-            sorting, symmetrize=True, window_ms=10.0, bin_ms=bin_ms
-        )
-        axes[i].bar(bins[1:], correlograms[0][1], width=bin_ms, align="center")
         axes[i].set_xticks(bins[1:])
         axes[i].set_xlabel("lag (ms)")
         axes[i].set_title(
             f"{cluster_id}_{cluster_isi_id}_xcorrelogram.png", pad=20
         )
 
-    z_uniq, z_ids = np.unique(geom[:, 1], return_inverse=True)
-    all_max_ptp = maxptps[
-        np.isin(labels, (*closest_clusters, cluster_id))
-    ].max()
+    z_uniq, z_ids = probe_rows(geom)
+    all_max_ptp = max(
+        maxptps[label_index[u]].max() for u in (*closest_clusters, cluster_id)
+    )
     scale = (z_uniq[1] - z_uniq[0]) / max(7, all_max_ptp)
 
     ax = ax_denoised
@@ -1351,6 +1440,8 @@ def plot_single_unit_summary(
         alpha=0.1,
         ax=ax,
         scale=scale,
+        label_index=label_index,
+        read_cache=read_cache,
         waveforms=wfs_full_denoise,
     )
     ax.set_title("denoised waveforms")
@@ -1374,6 +1465,8 @@ def plot_single_unit_summary(
         alpha=0.1,
         ax=ax,
         scale=scale,
+        label_index=label_index,
+        read_cache=read_cache,
         raw_bin=raw_bin,
     )
     ax.set_title("raw waveforms")
@@ -1398,6 +1491,8 @@ def plot_single_unit_summary(
         alpha=0.1,
         ax=ax,
         scale=scale,
+        label_index=label_index,
+        read_cache=read_cache,
         waveforms=wfs_subtracted,
         residual_bin=residual_bin,
     )
@@ -1411,6 +1506,43 @@ def plot_single_unit_summary(
     return fig
 
 
+# %%
+def _save_single_unit_summary(cluster_id, save_dir, *args, **kwargs):
+    path = Path(save_dir) / f"unit_{cluster_id:04d}.png"
+    # close whatever this unit opened even if plotting or saving fails,
+    # so that a long run over many units doesn't pile up figures
+    open_before = set(plt.get_fignums())
+    try:
+        fig = plot_single_unit_summary(cluster_id, *args, **kwargs)
+        fig.savefig(path)
+    finally:
+        for num in set(plt.get_fignums()) - open_before:
+            plt.close(num)
+    return path
+
+
+def plot_all_unit_summaries(
+    cluster_ids, save_dir, labels, *args, n_jobs=-1, **kwargs
+):
+    """plot_single_unit_summary for each of `cluster_ids`, saved to `save_dir`
+
+    The units are plotted in parallel by joblib's process pool. Large array
+    arguments (waveforms, features) are memmapped by joblib for the workers
+    rather than pickled for each job, so passing np.memmap or h5-loaded
+    arrays is fine. The other arguments are as in plot_single_unit_summary,
+    and the saved figures' paths are returned.
+    """
+    Path(save_dir).mkdir(exist_ok=True, parents=True)
+    kwargs.setdefault("label_index", get_label_index(labels))
+    jobs = (
+        delayed(_save_single_unit_summary)(
+            cluster_id, save_dir, labels, *args, **kwargs
+        )
+        for cluster_id in cluster_ids
+    )
+    return Parallel(n_jobs)(jobs)
+
+
 # %%
 def plot_agreement_venn(
     cluster_id_1,
@@ -1462,61 +1594,115 @@ def plot_agreement_venn(
     )
 
     # fig, axes = plt.subplots(1, 2, sharey=True, figsize=(12,12))
+    # matched and unmatched spikes of each unit go into one plot call,
+    # told apart by their colors and shifts
     h_shifts = [-10, 10]
-    colors = ["goldenrod", "red"]
-    indices = [ind_st1, not_match_ind_st1]
-    for indices_match, color, h_shift in zip(indices, colors, h_shifts):
-        if len(indices_match) > 0:
-            firstchans_cluster_sorting = firstchans_cluster_sorting1[
-                indices_match
+    for ax, st, firstchans, mcs_abs, indices, colors in (
+        (
+            ax_sorting1,
+            st_1,
+            firstchans_cluster_sorting1,
+            mcs_abs_cluster_sorting1,
+            (ind_st1, not_match_ind_st1),
+            ("goldenrod", "red"),
+        ),
+        (
+            ax_sorting2,
+            st_2,
+            firstchans_cluster_sorting2,
+            mcs_abs_cluster_sorting2,
+            (ind_st2, not_match_ind_st2),
+            ("goldenrod", "blue"),
+        ),
+    ):
+        # each group is subsampled to num_spikes_plot on its own
+        picks = [
+            indices_match[
+                np.random.default_rng(0).choice(
+                    len(indices_match),
+                    replace=False,
+                    size=min(len(indices_match), num_spikes_plot),
+                )
             ]
-            mcs_abs_cluster_sorting = mcs_abs_cluster_sorting1[indices_match]
-            spike_times = st_1[indices_match]
-            # geom, first_chans_cluster, mcs_abs_cluster, max_ptps_cluster, spike_times,
-            plot_waveforms_geom_unit(
-                geom,
-                firstchans_cluster_sorting,
-                mcs_abs_cluster_sorting,
-                spike_times,
-                raw_bin=raw_bin,
-                num_spikes_plot=num_spikes_plot,
-                t_range=t_range,
-                num_channels=num_channels,
-                num_rows=num_rows,
-                do_mean=False,
-                scale=scale,
-                h_shift=h_shift,
-                alpha=alpha,
-                ax=ax_sorting1,
-                color=color,
-            )
-    colors = ["goldenrod", "blue"]
-    indices = [ind_st2, not_match_ind_st2]
+            for indices_match in indices
+        ]
+        if not sum(map(len, picks)):
+            continue
+        spikes = np.concatenate(picks)
+        plot_waveforms_geom_unit(
+            geom,
+            firstchans[spikes],
+            mcs_abs[spikes],
+            st[spikes],
+            raw_bin=raw_bin,
+            num_spikes_plot=len(spikes),
+            t_range=t_range,
+            num_channels=num_channels,
+            num_rows=num_rows,
+            do_mean=False,
+            scale=scale,
+            h_shift=np.repeat(h_shifts, list(map(len, picks))),
+            alpha=alpha,
+            ax=ax,
+            color=np.repeat(colors, list(map(len, picks))),
+        )
+    return fig
+
+
+# %%
+def _plot_venn_side(
+    geom,
+    spike_train,
+    firstchans,
+    mcs_abs,
+    indices,
+    colors,
+    z_ids,
+    mcid,
+    ax_geom,
+    ax_shared,
+    ax_templates,
+    h_shifts=(-10, 10),
+    **plot_kwargs,
+):
+    """One sorting's half of plot_agreement_venn_better
+
+    Draws each group of spikes in `indices` (matched, then unmatched) on
+    the probe, flattened around the first group's main channel, and as a
+    template.
+    """
+    shared_mc = -1
     for indices_match, color, h_shift in zip(indices, colors, h_shifts):
-        if len(indices_match) > 0:
-            mcs_abs_cluster_sorting = mcs_abs_cluster_sorting2[indices_match]
-            firstchans_cluster_sorting = firstchans_cluster_sorting2[
-                indices_match
-            ]
-            spike_times = st_2[indices_match]
-            plot_waveforms_geom_unit(
-                geom,
-                firstchans_cluster_sorting,
-                mcs_abs_cluster_sorting,
-                spike_times,
-                raw_bin=raw_bin,
-                num_spikes_plot=num_spikes_plot,
-                t_range=t_range,
-                num_channels=num_channels,
-                num_rows=num_rows,
-                do_mean=False,
-                scale=scale,
-                h_shift=h_shift,
-                alpha=alpha,
-                ax=ax_sorting2,
+        if not len(indices_match):
+            continue
+        waveforms, _ = plot_waveforms_geom_unit_with_return(
+            geom,
+            firstchans[indices_match],
+            mcs_abs[indices_match],
+            spike_train[indices_match],
+            z_ids,
+            mcid,
+            h_shift=h_shift,
+            ax=ax_geom,
+            color=color,
+            **plot_kwargs,
+        )
+        if shared_mc < 0:
+            shared_mc = np.ptp(waveforms.mean(0), axis=0).argmax()
+        for i in range(min(len(waveforms), plot_kwargs["num_spikes_plot"])):
+            ax_shared.plot(
+                waveforms[i, :, shared_mc - 5 : shared_mc + 6].T.flatten(),
+                alpha=plot_kwargs["alpha"],
                 color=color,
             )
-    return fig
+        for i in range(10):
+            ax_shared.axvline(121 + 121 * i, c="black")
+        ax_templates.plot(
+            waveforms[:, :, shared_mc - 5 : shared_mc + 6]
+            .mean(0)
+            .T.flatten(),
+            color=color,
+        )
 
 
 # %%
@@ -1550,12 +1736,8 @@ def plot_agreement_venn_better(
 ):
     
     
-    vals, counts = np.unique(
-        mcs_abs_cluster_sorting1,
-        return_counts=True,
-    )
-    z_uniq, z_ids = np.unique(geom[:, 1], return_inverse=True)
-    mcid = z_ids[vals[counts.argmax()]]
+    z_uniq, z_ids = probe_rows(geom)
+    mcid = z_ids[mode_channel(mcs_abs_cluster_sorting1)]
 
     lab_st1 = cluster_id_1
     lab_st2 = cluster_id_2
@@ -1619,7 +1801,7 @@ def plot_agreement_venn_better(
         replace=False,
         size=min((labels_yass == cluster_id_1).sum(), num_spikes_plot),
     )
-    waveforms_read = read_waveforms(
+    temp1, _ = read_waveforms_mean(
         spike_index_yass[labels_yass == cluster_id_1, 0][some_in_cluster],
         raw_bin,
         geom.shape[0],
@@ -1627,8 +1809,7 @@ def plot_agreement_venn_better(
         channels=np.arange(first_chan_yass_ks, first_chan_yass_ks + 20).astype(
             "int"
         ),
-    )[0]
-    temp1 = waveforms_read.mean(0)
+    )
     ax_yass_temps.plot(temp1.T.flatten(), color="red")
 
     for j in range(num_close_clusters):
@@ -1639,7 +1820,7 @@ def plot_agreement_venn_better(
                 (labels_yass == closest_clusters_hdb[j]).sum(), num_spikes_plot
             ),
         )
-        waveforms_read = read_waveforms(
+        temp_close, _ = read_waveforms_mean(
             spike_index_yass[labels_yass == closest_clusters_hdb[j], 0][
                 some_in_cluster
             ],
@@ -1649,8 +1830,8 @@ def plot_agreement_venn_better(
             channels=np.arange(
                 int(first_chan_yass_ks), int(first_chan_yass_ks) + 20
             ),
-        )[0]
-        ax_yass_temps.plot(waveforms_read.mean(0).T.flatten())
+        )
+        ax_yass_temps.plot(temp_close.T.flatten())
     for i in range(20):
         ax_yass_temps.axvline(121 + 121 * i, c="black")
     ax_yass_temps.set_title(f"{sorting1_name} close templates")
@@ -1660,7 +1841,7 @@ def plot_agreement_venn_better(
         replace=False,
         size=min((labels_ks == cluster_id_2).sum(), num_spikes_plot),
     )
-    waveforms_read = read_waveforms(
+    temp2, _ = read_waveforms_mean(
         spike_index_ks[labels_ks == cluster_id_2, 0][some_in_cluster],
         raw_bin,
         geom.shape[0],
@@ -1668,8 +1849,7 @@ def plot_agreement_venn_better(
         channels=np.arange(first_chan_yass_ks, first_chan_yass_ks + 20).astype(
             "int"
         ),
-    )[0]
-    temp2 = waveforms_read.mean(0)
+    )
     ax_ks_temps.plot(temp2.T.flatten(), color="blue")
 
     for j in range(num_close_clusters):
@@ -1681,7 +1861,7 @@ def plot_agreement_venn_better(
             ),
         )
         if len(some_in_cluster) > 0:
-            waveforms_read = read_waveforms(
+            temp_close, _ = read_waveforms_mean(
                 spike_index_ks[labels_ks == closest_clusters_kilo[j], 0][
                     some_in_cluster
                 ],
@@ -1691,120 +1871,51 @@ def plot_agreement_venn_better(
                 channels=np.arange(
                     first_chan_yass_ks, first_chan_yass_ks + 20
                 ).astype("int"),
-            )[0]
-            ax_ks_temps.plot(waveforms_read.mean(0).T.flatten())
+            )
+            ax_ks_temps.plot(temp_close.T.flatten())
     for i in range(20):
         ax_ks_temps.axvline(121 + 121 * i, c="black")
     ax_ks_temps.set_title(f"{sorting2_name} close templates")
 
     # fig, axes = plt.subplots(1, 2, sharey=True, figsize=(12,12))
-    h_shifts = [-10, 10]
-    colors = ["goldenrod", "red"]
-    indices = [ind_st1, not_match_ind_st1]
-    cmp = 0
-    shared_mc1 = -1
-    for indices_match, color, h_shift in zip(indices, colors, h_shifts):
-        if len(indices_match) > 0:
-            firstchans_cluster_sorting = firstchans_cluster_sorting1[
-                indices_match
-            ]
-            mcs_abs_cluster_sorting = mcs_abs_cluster_sorting1[indices_match]
-            spike_times = st_1[indices_match]
-            # geom, first_chans_cluster, mcs_abs_cluster, max_ptps_cluster, spike_times,
-            (
-                waveforms,
-                first_chan_cluster,
-            ) = plot_waveforms_geom_unit_with_return(
-                geom,
-                firstchans_cluster_sorting,
-                mcs_abs_cluster_sorting,
-                spike_times,
-                z_ids, 
-                mcid,
-                raw_bin=raw_bin,
-                num_spikes_plot=num_spikes_plot,
-                t_range=t_range,
-                num_channels=num_channels,
-                num_rows=num_rows,
-                do_mean=False,
-                scale=scale,
-                h_shift=h_shift,
-                alpha=alpha,
-                ax=ax_sorting1,
-                color=color,
-            )
-            if shared_mc1 < 0:
-                shared_mc1 = waveforms.mean(0).ptp(0).argmax()
-            for i in range(min(len(waveforms), num_spikes_plot)):
-                ax_wfs_shared_yass.plot(
-                    waveforms[
-                        i, :, shared_mc1 - 5 : shared_mc1 + 6
-                    ].T.flatten(),
-                    alpha=alpha,
-                    color=color,
-                )
-            for i in range(10):
-                ax_wfs_shared_yass.axvline(121 + 121 * i, c="black")
-            ax_templates.plot(
-                waveforms[:, :, shared_mc1 - 5 : shared_mc1 + 6]
-                .mean(0)
-                .T.flatten(),
-                color=color,
-            )
-            cmp += 1
-    colors = ["goldenrod", "blue"]
-    indices = [ind_st2, not_match_ind_st2]
-    shared_mc2 = -1
-    for indices_match, color, h_shift in zip(indices, colors, h_shifts):
-        if len(indices_match) > 0:
-            mcs_abs_cluster_sorting = mcs_abs_cluster_sorting2[indices_match]
-            firstchans_cluster_sorting = firstchans_cluster_sorting2[
-                indices_match
-            ]
-            spike_times = st_2[indices_match]
-
-            (
-                waveforms,
-                first_chan_cluster,
-            ) = plot_waveforms_geom_unit_with_return(
-                geom,
-                firstchans_cluster_sorting,
-                mcs_abs_cluster_sorting,
-                spike_times,
-                z_ids,
-                mcid,
-                raw_bin=raw_bin,
-                num_spikes_plot=num_spikes_plot,
-                t_range=t_range,
-                num_channels=num_channels,
-                num_rows=num_rows,
-                do_mean=False,
-                scale=scale,
-                h_shift=h_shift,
-                alpha=alpha,
-                ax=ax_sorting2,
-                color=color,
-            )
-            # mc = waveforms.mean(0).ptp(0).argmax()
-            if shared_mc2 < 0:
-                shared_mc2 = waveforms.mean(0).ptp(0).argmax()
-
-            for i in range(min(len(waveforms), num_spikes_plot)):
-                ax_wfs_shared_ks.plot(
-                    waveforms[
-                        i, :, shared_mc2 - 5 : shared_mc2 + 6
-                    ].T.flatten(),
-                    alpha=alpha,
-                    color=color,
-                )
-            for i in range(10):
-                ax_wfs_shared_ks.axvline(121 + 121 * i, c="black")
-            ax_templates.plot(
-                waveforms[:, :, shared_mc2 - 5 : shared_mc2 + 6]
-                .mean(0)
-                .T.flatten(),
-                color=color,
-            )
+    plot_kwargs = dict(
+        raw_bin=raw_bin,
+        num_spikes_plot=num_spikes_plot,
+        t_range=t_range,
+        num_channels=num_channels,
+        num_rows=num_rows,
+        do_mean=False,
+        scale=scale,
+        alpha=alpha,
+    )
+    _plot_venn_side(
+        geom,
+        st_1,
+        firstchans_cluster_sorting1,
+        mcs_abs_cluster_sorting1,
+        (ind_st1, not_match_ind_st1),
+        ("goldenrod", "red"),
+        z_ids,
+        mcid,
+        ax_sorting1,
+        ax_wfs_shared_yass,
+        ax_templates,
+        **plot_kwargs,
+    )
+    _plot_venn_side(
+        geom,
+        st_2,
+        firstchans_cluster_sorting2,
+        mcs_abs_cluster_sorting2,
+        (ind_st2, not_match_ind_st2),
+        ("goldenrod", "blue"),
+        z_ids,
+        mcid,
+        ax_sorting2,
+        ax_wfs_shared_ks,
+        ax_templates,
+        **plot_kwargs,
+    )
     for i in range(10):
         ax_templates.axvline(121 + 121 * i, c="black")
 
@@ -1849,10 +1960,6 @@ def plot_waveforms_geom_unit_with_return(
     spike_times = spike_times[some_in_cluster]
 
     # what channels will we plot?
-    vals, counts = np.unique(
-        mcs_abs_cluster,
-        return_counts=True,
-    )
 #     z_uniq, z_ids = np.unique(geom[:, 1], return_inverse=True)
 #     mcid = z_ids[vals[counts.argmax()]]
     channels_plot = np.flatnonzero(
@@ -1880,28 +1987,9 @@ def plot_waveforms_geom_unit_with_return(
 
     if raw_bin is not None:
         # raw data and spike times passed in
-        if len(np.unique(first_chans_cluster))>1:
-            waveforms_read = read_waveforms(
-                spike_times, raw_bin, geom.shape[0], spike_length_samples=121
-            )[0]
-            waveforms = []
-            for i, waveform in enumerate(waveforms_read):
-                waveforms.append(
-                    waveform[
-                        :,
-                        int(first_chans_cluster[i]) : int(first_chans_cluster[i])
-                        + num_channels,
-                    ].copy()
-                )
-            waveforms = np.asarray(waveforms)
-        else:
-            waveforms = read_waveforms(
-                spike_times,
-                raw_bin,
-                geom.shape[0],
-                channels=np.arange(first_chans_cluster[0], first_chans_cluster[0]+num_channels),
-                spike_length_samples=121,
-            )[0]
+        waveforms = read_neighborhoods(
+            spike_times, raw_bin, geom, first_chans_cluster, num_channels
+        )
 
     elif waveforms_cluster is None:
         # no raw data and no waveforms passed - bad!
@@ -1911,21 +1999,9 @@ def plot_waveforms_geom_unit_with_return(
         waveforms = waveforms_cluster[some_in_cluster]
         if residual_bin is not None:
             # add residuals
-            residuals_read = read_waveforms(
-                spike_times, residual_bin, geom.shape[0], spike_length_samples=121
-            )[0]
-            residuals = []
-            for i, residual in enumerate(residuals_read):
-                residuals.append(
-                    residual[
-                        :,
-                        int(first_chans_cluster[i]) : int(
-                            first_chans_cluster[i]
-                        )
-                        + num_channels,
-                    ]
-                )
-            residuals = np.asarray(residuals)
+            residuals = read_neighborhoods(
+                spike_times, residual_bin, geom, first_chans_cluster, num_channels
+            )
             waveforms = waveforms + residuals
     if denoiser is not None and device is not None:
         # denoise waveforms
@@ -1935,30 +2011,22 @@ def plot_waveforms_geom_unit_with_return(
     if do_mean:
         # plot the mean rather than the invididual spikes
         waveforms = np.expand_dims(np.mean(waveforms, axis=0), 0)
-    draw_lines = []
-    for i in range(min(len(waveforms), num_spikes_plot)):
-        for k, channel in enumerate(
-            range(
-                int(first_chans_cluster[i]),
-                int(first_chans_cluster[i]) + waveforms.shape[2],
-            )
-        ):
-            if channel in channels_plot:
-                trace = waveforms[
-                    i,
-                    t_range[0] : t_range[1],
-                    k,
-                ]
-            else:
-                continue
-            waveform = trace * scale
-            draw_lines.append(geom[channel, 0] + times_plot + h_shift)
-            draw_lines.append(waveform + geom[channel, 1])
-    ax.plot(
-        *draw_lines,
-        alpha=alpha,
-        c=color,
+    segments, _, _ = waveform_segments(
+        waveforms,
+        first_chans_cluster,
+        channels_plot,
+        geom,
+        times_plot,
+        t_range,
+        scale,
+        num_spikes_plot,
+        x_shift=h_shift,
     )
+    # one collection for all of the traces, rather than a Line2D each
+    ax.add_collection(
+        LineCollection(segments, colors=color, alpha=alpha, rasterized=True)
+    )
+    ax.autoscale_view()
     ax.set_xticks([])
     # ax.yaxis.tick_right()
     return waveforms, first_chans_cluster
@@ -1980,6 +2048,8 @@ def plot_unit_similarity_heatmaps(
     normalize_agreement_by="both",
     ax_similarity=None,
     ax_agreement=None,
+    template_cache=None,
+    similarity_metric="maxabs",
 ):
     if ax_similarity is None:
         plt.figure(figsize=(9, 3))
@@ -2008,6 +2078,8 @@ def plot_unit_similarity_heatmaps(
         shifts_align,
         order_by,
         normalize_agreement_by,
+        template_cache=template_cache,
+        similarity_metric=similarity_metric,
     )
 
     agreements = agreements[:num_close_clusters_plot]
@@ -2029,7 +2101,10 @@ def plot_unit_similarity_heatmaps(
         ax=ax_similarity,
         cbar=False,
     )
-    ax_similarity.set_title("Max Abs Norm Similarity")
+    if similarity_metric == "cosine":
+        ax_similarity.set_title("Cosine Distance")
+    else:
+        ax_similarity.set_title("Max Abs Norm Similarity")
     g = sns.heatmap(
         np.expand_dims(agreements, 0),
         vmin=0,
@@ -2079,6 +2154,8 @@ def plot_unit_similarities(
     non_triaged_idxs=None,
     triaged_mcs_abs=None,
     triaged_firstchans=None,
+    template_cache=None,
+    similarity_metric="maxabs",
 ):
     do_denoised_waveform = (
         denoised_waveforms is not None
@@ -2101,7 +2178,11 @@ def plot_unit_similarities(
     if do_denoised_waveform:
         ax_denoised_wf = plt.subplot(gs[:4, 3])
 
-    st_1 = sorting1.get_unit_spike_train(cluster_id)
+    spike_train_getters = [
+        spike_train_getter(sorting1),
+        spike_train_getter(sorting2),
+    ]
+    st_1 = spike_train_getters[0](cluster_id)
     firing_rate = len(st_1) / recoring_duration  # in seconds
 
     # compute similarity to closest kilosort clusters
@@ -2129,11 +2210,15 @@ def plot_unit_similarities(
         shifts_align=shifts_align,
         order_by=order_by,
         normalize_agreement_by=normalize_agreement_by,
+        template_cache=template_cache,
+        similarity_metric=similarity_metric,
     )
 
-    max_ptp_channel = np.argmax(original_template.ptp(0))
-    max_ptp = np.max(original_template.ptp(0))
-    z_uniq, z_ids = np.unique(geom[:, 1], return_inverse=True)
+    template1, _, max_ptp_channel = template_channel_window(
+        original_template, num_channels_similarity
+    )
+    max_ptp = np.ptp(original_template, axis=0).max()
+    z_uniq, z_ids = probe_rows(geom)
     scale = (z_uniq[1] - z_uniq[0]) / max(7, max_ptp)
 
     plot_isi_distribution(st_1, ax=ax_isi)
@@ -2144,17 +2229,16 @@ def plot_unit_similarities(
     t_shifts = [0, most_similar_shift]
     colors = [("blue", "darkblue"), ("red", "darkred")]
     cluster_ids_plot = [cluster_id, most_similar_cluster]
-    sortings_plot = [sorting1, sorting2]
-    for cluster_id_plot, color, sorting_plot, h_shift, t_shift in zip(
-        cluster_ids_plot, colors, sortings_plot, h_shifts, t_shifts
+    for cluster_id_plot, color, unit_spike_train, h_shift, t_shift in zip(
+        cluster_ids_plot, colors, spike_train_getters, h_shifts, t_shifts
     ):
-        spike_times = (
-            sorting_plot.get_unit_spike_train(cluster_id_plot) + t_shift
+        spike_times = unit_spike_train(cluster_id_plot) + t_shift
+        mcs_abs_cluster = np.full(
+            len(spike_times), max_ptp_channel, dtype=np.int64
         )
-        mcs_abs_cluster = (
-            np.zeros(len(spike_times)).astype("int") + max_ptp_channel
+        first_chans_cluster = np.full(
+            len(spike_times), max(max_ptp_channel - 20, 0), dtype=np.int64
         )
-        first_chans_cluster = (mcs_abs_cluster - 20).clip(min=0)
 
         # waveform_scale = 1/25
 
@@ -2208,11 +2292,6 @@ def plot_unit_similarities(
         ax_denoised_wf.set_title(
             f"cluster {cluster_id}/cluster {most_similar_cluster} denoised, shift {most_similar_shift}"
         )
-    channel_range = (
-        max(max_ptp_channel - num_channels_similarity // 2, 0),
-        max_ptp_channel + num_channels_similarity // 2,
-    )
-    template1 = original_template[:, channel_range[0] : channel_range[1]]
     most_similar_template = templates[0]
     if most_similar_shift == 0:
         most_similar_template_flattened = most_similar_template.T.flatten()
@@ -2369,25 +2448,18 @@ def diagnostic_plots(
     indices = [ind_st1, not_match_ind_st1]
     # FIX CHANNEL INDEX!!
     
-    vals, counts = np.unique(
-        mcs_abs_cluster_sorting1,
-        return_counts=True,
-    )
-    z_uniq, z_ids = np.unique(geom[:, 1], return_inverse=True)
-    mcid = z_ids[vals[counts.argmax()]]
+    z_uniq, z_ids = probe_rows(geom)
+    mcid = z_ids[mode_channel(mcs_abs_cluster_sorting1)]
     
     cmp = 0
     wfs_shared = np.array([])
     wfs_lda_red = np.array([])
     if ind_st1.size:
-        u, c = np.unique(mcs_abs_cluster_sorting1[ind_st1], return_counts=True)
-        shared_mc = u[c.argmax()]
+        shared_mc = mode_channel(mcs_abs_cluster_sorting1[ind_st1])
     elif not_match_ind_st1.size:
-        u, c = np.unique(mcs_abs_cluster_sorting1[not_match_ind_st1], return_counts=True)
-        shared_mc = u[c.argmax()]
+        shared_mc = mode_channel(mcs_abs_cluster_sorting1[not_match_ind_st1])
     elif not_match_ind_st2.size:
-        u, c = np.unique(mcs_abs_cluster_sorting2[not_match_ind_st2], return_counts=True)
-        shared_mc = u[c.argmax()]
+        shared_mc = mode_channel(mcs_abs_cluster_sorting2[not_match_ind_st2])
     else:
         assert False
     template_red = None
@@ -3193,25 +3265,18 @@ def diagnostic_plots_with_outliers(
     indices = [ind_st1, not_match_ind_st1]
     # FIX CHANNEL INDEX!!
     
-    vals, counts = np.unique(
-        mcs_abs_cluster_sorting1,
-        return_counts=True,
-    )
-    z_uniq, z_ids = np.unique(geom[:, 1], return_inverse=True)
-    mcid = z_ids[vals[counts.argmax()]]
+    z_uniq, z_ids = probe_rows(geom)
+    mcid = z_ids[mode_channel(mcs_abs_cluster_sorting1)]
     
     cmp = 0
     wfs_shared = np.array([])
     wfs_lda_red = np.array([])
     if ind_st1.size:
-        u, c = np.unique(mcs_abs_cluster_sorting1[ind_st1], return_counts=True)
-        shared_mc = u[c.argmax()]
+        shared_mc = mode_channel(mcs_abs_cluster_sorting1[ind_st1])
     elif not_match_ind_st1.size:
-        u, c = np.unique(mcs_abs_cluster_sorting1[not_match_ind_st1], return_counts=True)
-        shared_mc = u[c.argmax()]
+        shared_mc = mode_channel(mcs_abs_cluster_sorting1[not_match_ind_st1])
     elif not_match_ind_st2.size:
-        u, c = np.unique(mcs_abs_cluster_sorting2[not_match_ind_st2], return_counts=True)
-        shared_mc = u[c.argmax()]
+        shared_mc = mode_channel(mcs_abs_cluster_sorting2[not_match_ind_st2])
     else:
         assert False
     template_red = None
@@ -1,18 +1,169 @@
 # %%
 import multiprocessing
 import os
-import pickle
 import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from itertools import repeat
 from pathlib import Path
 
+import numba
 import numpy as np
-from scipy import signal
+from scipy import fft, signal
 from spike_psvae import snr_templates
-from spike_psvae.spikeio import read_data, read_waveforms
+from spike_psvae.spikeio import read_waveforms
 from tqdm.auto import tqdm, trange
 
 
+# %%
+def _temporal_rfft(temporal, singular):
+    """rfft along time of each unit's singular-weighted temporal components
+
+    Padded to the length of a full convolution of two templates, so that
+    pairwise convolutions can be taken by products in the frequency domain.
+    """
+    nfft = fft.next_fast_len(2 * temporal.shape[1] - 1, real=True)
+    return fft.rfft(temporal * singular[:, None, :], n=nfft, axis=1)
+
+
+@numba.njit(nogil=True, parallel=True)
+def _subtract_pconv(out, pconv, chans, times, scales):
+    """out[chans[c], times[s] + t] -= scales[s] * pconv[c, t]
+
+    Parallel over channels, so that spikes whose windows overlap in
+    time still accumulate correctly.
+    """
+    for c in numba.prange(chans.size):
+        ch = chans[c]
+        for s in range(times.size):
+            t0 = times[s]
+            for t in range(pconv.shape[1]):
+                out[ch, t0 + t] -= scales[s] * pconv[c, t]
+
+
+def _npz_headers(fname):
+    """Shape and dtype of each array in an .npz, read without loading it"""
+    headers = {}
+    with zipfile.ZipFile(fname) as zf:
+        for name in zf.namelist():
+            with zf.open(name) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(f)
+                else:
+                    header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            headers[name.removesuffix(".npy")] = shape, dtype
+    return headers
+
+
+def _gather_npz(fnames, keys, n_workers=1):
+    """Concatenate the arrays under keys across .npz files
+
+    Sizes the outputs from the files' headers first, so that each file's
+    arrays are copied once, straight into place. Files are read on
+    n_workers threads, since file reads release the GIL.
+    """
+    headers = [_npz_headers(fname) for fname in fnames]
+    gathered = {}
+    for key in keys:
+        shapes = [h[key][0] for h in headers]
+        gathered[key] = np.empty(
+            (sum(shape[0] for shape in shapes), *shapes[0][1:]),
+            dtype=np.result_type(*(h[key][1] for h in headers)),
+        )
+
+    counts = [h[keys[0]][0][0] for h in headers]
+    offsets = np.cumsum(counts) - counts
+
+    def load_one(fname, offset, n):
+        with np.load(fname) as d:
+            for key in keys:
+                gathered[key][offset : offset + n] = d[key]
+
+    with ThreadPoolExecutor(max(1, n_workers)) as pool:
+        # list() so that any worker's exception is raised here
+        list(pool.map(load_one, fnames, offsets, counts))
+
+    return gathered
+
+
+def _grow(buffer, n_used, capacity):
+    """Copy the first n_used rows of buffer into a new one of capacity rows"""
+    grown = np.empty((capacity, *buffer.shape[1:]), dtype=buffer.dtype)
+    grown[:n_used] = buffer[:n_used]
+    return grown
+
+
+@numba.njit(nogil=True)
+def _fill_windows(out, rows, centers, radius, value):
+    """out[rows[i], centers[i] - radius : centers[i] + radius + 1] = value
+
+    Windows are clipped to the bounds of out.
+    """
+    for i in range(rows.size):
+        lo = max(centers[i] - radius, 0)
+        hi = min(centers[i] + radius + 1, out.shape[1])
+        for t in range(lo, hi):
+            out[rows[i], t] = value
+
+
+@numba.njit(nogil=True, parallel=True)
+def _max_argmax_over_units(obj):
+    """np.max(obj, axis=0) and np.argmax(obj, axis=0) in one pass
+
+    Parallel over blocks of time, sweeping each block unit by unit so
+    that the inner loop reads contiguous memory.
+    """
+    n_units, n_times = obj.shape
+    maxes = np.full(n_times, -np.inf, dtype=obj.dtype)
+    argmaxes = np.zeros(n_times, dtype=np.int64)
+    block = 4096
+    for b in numba.prange((n_times + block - 1) // block):
+        t0 = b * block
+        t1 = min(t0 + block, n_times)
+        for u in range(n_units):
+            for t in range(t0, t1):
+                if obj[u, t] > maxes[t]:
+                    maxes[t] = obj[u, t]
+                    argmaxes[t] = u
+    return maxes, argmaxes
+
+
+@numba.njit(nogil=True)
+def _thresholded_relmax(x, threshold, order):
+    """Indices i with x[i] > threshold and x[i] > x[j] for 0 < |i - j| <= order
+
+    Matches signal.argrelmax(x, order=order) followed by the threshold
+    mask, including argrelmax's exclusion of the two endpoints, but
+    skips the window comparisons for samples below threshold.
+    """
+    n = x.size
+    peaks = np.empty(n, dtype=np.int64)
+    n_peaks = 0
+    for i in range(1, n - 1):
+        xi = x[i]
+        if not xi > threshold:
+            continue
+        is_peak = True
+        for j in range(max(0, i - order), min(n, i + order + 1)):
+            if j != i and not xi > x[j]:
+                is_peak = False
+                break
+        if is_peak:
+            peaks[n_peaks] = i
+            n_peaks += 1
+    return peaks[:n_peaks]
+
+
+def _quantize_int16(pconv):
+    """Scale pconv into int16, returning the int16 array and the scale."""
+    scale = np.abs(pconv).max(initial=0) / np.iinfo(np.int16).max
+    if scale == 0:
+        return np.zeros(pconv.shape, dtype=np.int16), np.float32(1)
+    return np.round(pconv / scale).astype(np.int16), np.float32(scale)
+
+
 # %%
 class MatchPursuitObjectiveUpsample:
     """Class for doing greedy matching pursuit deconvolution."""
@@ -39,6 +190,7 @@ class MatchPursuitObjectiveUpsample:
         verbose=False,
         template_index_to_unit_id=None,
         refractory_period_frames=10,
+        quantize_pairwise_conv=False,
     ):
         """Sets up the deconvolution object.
 
@@ -62,6 +214,11 @@ class MatchPursuitObjectiveUpsample:
             If multiple templates correspond to the same unit (e.g. supperres),
             specify that here so that we can correctly enforce the refractory
             period.
+        quantize_pairwise_conv : bool
+            If True, store each upsampled unit's pairwise convolutions as
+            int16 with a per-unit scale, halving the memory read while
+            subtracting spikes, at a relative error of about 1.5e-5 of
+            that unit's largest value.
         """
 
         self.verbose = verbose
@@ -109,6 +266,7 @@ class MatchPursuitObjectiveUpsample:
         self.max_iter = max_iter
         self.n_processors = n_processors
         self.multi_processing = multi_processing
+        self.quantize_pairwise_conv = quantize_pairwise_conv
 
         # figure out length of data
         if standardized_bin is not None:
@@ -149,6 +307,10 @@ class MatchPursuitObjectiveUpsample:
         self.threshold = threshold
         self.approx_rank = conv_approx_rank
         self.vis_su_threshold = vis_su
+        # reused by compute_objective and run_batch across batches of the
+        # same length
+        self.obj_buffer = None
+        self.data_buffer = None
         self.visible_chans()
         self.template_overlaps()
         self.spatially_mask_templates()
@@ -184,6 +346,11 @@ class MatchPursuitObjectiveUpsample:
         radius = factor // 2 + factor % 2  # 4
         self.up_window = np.arange(-radius, radius + 1)[:, None]  # [-4, 4]  up-> [-32, 32]
         self.up_window_len = len(self.up_window)  # 16
+        # signal.resample is linear, so upsampling the window around each
+        # peak is a matrix product with the resampled identity
+        self.peak_upsampling_matrix = signal.resample(
+            np.eye(self.up_window_len), self.up_window_len * factor
+        )
 
         # Indices of single time window the window around peak after upsampling
         self.zoom_index = radius * factor + np.arange(-radius, radius + 1)  # 8*4 + [-4, 4] = [32 - 4, 32 + 4] ->(in up space) = [-4, 4]
@@ -211,7 +378,7 @@ class MatchPursuitObjectiveUpsample:
             max_upsample = upsample
             # original function
             self.unit_up_factor = np.power(
-                4, np.floor(np.log2(self.temps.ptp(axis=0).max(axis=0)))
+                4, np.floor(np.log2(np.ptp(self.temps, axis=0).max(axis=0)))
             )
             self.up_factor = np.clip(int(np.max(self.unit_up_factor)), 1, max_upsample)
             self.unit_up_factor[
@@ -235,9 +402,15 @@ class MatchPursuitObjectiveUpsample:
             self.unit_up_factor = np.ones(self.n_unit, dtype=int)
             self.up_up_map = np.arange(self.n_unit * self.up_factor)
 
+        # the upsampled units which are actually used. up_up_map is
+        # nondecreasing, so these are the values where it steps up.
+        self.up_up_unique = self.up_up_map[
+            np.flatnonzero(np.diff(self.up_up_map, prepend=-1))
+        ]
+
     def update_data(self):
         """Updates the data for the deconv to be run on with same templates."""
-        self.data = self.data.astype(np.float32)
+        self.data = self.data.astype(np.float32, copy=False)
         self.data_len = self.data.shape[0]
 
         # Computing SVD for each template.
@@ -248,34 +421,38 @@ class MatchPursuitObjectiveUpsample:
 
         # Resulting recovered spike train.
         self.dec_spike_train = np.zeros([0, 2], dtype=np.int32)
+        self.dec_scalings = np.zeros(0, dtype=np.float32)
         self.dist_metric = np.array([])
         self.iter_spike_train = []
 
     def visible_chans(self):
-        self.vis_chan = self.temps.ptp(0) > self.vis_su_threshold
+        self.vis_chan = np.ptp(self.temps, axis=0) > self.vis_su_threshold
 
     def template_overlaps(self):
         """Find pairwise units that have overlap between."""
-        vis = self.vis_chan.T
-        self.unit_overlap = np.sum(
-            np.logical_and(vis[:, None, :], vis[None, :, :]), axis=2
-        )
-        self.unit_overlap = self.unit_overlap > 0
+        # count shared visible channels with one matrix product rather
+        # than an (n_unit, n_unit, n_chan) boolean intermediate
+        vis = self.vis_chan.T.astype(np.float32)
+        self.unit_overlap = (vis @ vis.T) > 0
         self.unit_overlap = np.repeat(
             self.unit_overlap, self.up_factor, axis=0
         )
 
+        # the same, in CSR form: the units overlapping upsampled unit i are
+        # overlap_indices[overlap_indptr[i] : overlap_indptr[i + 1]]
+        self.overlap_indptr = np.zeros(len(self.unit_overlap) + 1, dtype=int)
+        np.cumsum(self.unit_overlap.sum(axis=1), out=self.overlap_indptr[1:])
+        self.overlap_indices = np.nonzero(self.unit_overlap)[1]
+
     def spatially_mask_templates(self):
         """Spatially mask templates so that non visible channels are zero."""
-        idx = np.logical_xor(
-            np.ones(self.temps.shape, dtype=bool), self.vis_chan
-        )
-        self.temps[idx] = 0.0
+        self.temps[:, ~self.vis_chan] = 0.0
 
     def compress_templates(self):
         """Compresses the templates using SVD and upsample temporal compoents."""
+        # only the leading components are kept, so skip the full bases
         self.temporal, self.singular, self.spatial = np.linalg.svd(
-            np.transpose(self.temps, (2, 0, 1))
+            np.transpose(self.temps, (2, 0, 1)), full_matrices=False
         )
 
         # Keep only the strongest components
@@ -301,34 +478,30 @@ class MatchPursuitObjectiveUpsample:
             ).astype(np.float32)
 
         self.temporal = np.flip(self.temporal, axis=1)
-        temporal_up = np.flip(temporal_up, axis=1)
-
-        if self.multi_processing:
-            np.savez(
-                os.path.join(self.deconv_dir, "svd.npz"),
-                temporal_up=temporal_up,
-                temporal=self.temporal,
-                singular=self.singular,
-                spatial=self.spatial,
-            )
-        else:
-            self.temporal_up = temporal_up
+        self.temporal_up = np.flip(temporal_up, axis=1)
 
     def conv_filter(
         self,
         unit_array,
-        temporal,
+        temporal_fft,
         temporal_up,
         singular,
         spatial,
     ):
+        conv_res_len = self.n_time * 2 - 1
+        nfft = fft.next_fast_len(conv_res_len, real=True)
         pairwise_conv_array = []
         for unit2 in unit_array:
-            conv_res_len = self.n_time * 2 - 1
-            n_overlap = np.sum(self.unit_overlap[unit2, :])
+            overlap_units = self.overlap_indices[
+                self.overlap_indptr[unit2] : self.overlap_indptr[unit2 + 1]
+            ]
+            n_overlap = overlap_units.size
             pairwise_conv = np.zeros(
                 [n_overlap, conv_res_len], dtype=np.float32
             )
+            if not n_overlap:
+                pairwise_conv_array.append(pairwise_conv)
+                continue
             orig_unit = unit2 // self.up_factor
             masked_temp = np.flipud(
                 np.matmul(
@@ -337,78 +510,107 @@ class MatchPursuitObjectiveUpsample:
                 )
             )
 
-            for j, unit1 in enumerate(
-                np.where(self.unit_overlap[unit2, :])[0]
-            ):
-                u, s, vh = temporal[unit1], singular[unit1], spatial[unit1]
+            mat_mul_res = np.empty(
+                [n_overlap, self.n_time, self.approx_rank], dtype=np.float32
+            )
+            for j, unit1 in enumerate(overlap_units):
                 vis_chan_idx = self.vis_chan[:, unit1]
-                mat_mul_res = np.matmul(
+                mat_mul_res[j] = np.matmul(
                     masked_temp[:, vis_chan_idx],
-                    vh[: self.approx_rank, vis_chan_idx].T,
+                    spatial[unit1][: self.approx_rank, vis_chan_idx].T,
                 )
 
-                for i in range(self.approx_rank):
-                    pairwise_conv[j, :] += np.convolve(
-                        mat_mul_res[:, i], s[i] * u[:, i].flatten(), "full"
-                    )
+            # convolve every rank of every overlapping unit against their
+            # precomputed temporal transforms, summing over ranks before
+            # transforming back
+            mat_mul_fft = fft.rfft(mat_mul_res, n=nfft, axis=1)
+            pairwise_conv[:] = fft.irfft(
+                (mat_mul_fft * temporal_fft[overlap_units]).sum(axis=2),
+                n=nfft,
+                axis=1,
+            )[:, :conv_res_len]
 
             pairwise_conv_array.append(pairwise_conv)
 
         return pairwise_conv_array
 
-    def parallel_conv_filter(self, args):
-        proc_index, unit_array = args
-
-        # load template SVD from disk (pickle size limit)
-        with np.load(os.path.join(self.deconv_dir, "svd.npz")) as data:
-            temporal_up = data["temporal_up"]
-            temporal = data["temporal"]
-            singular = data["singular"]
-            spatial = data["spatial"]
-
+    def parallel_conv_filter(self, unit_array, row_starts, temporal_fft, out):
         pairwise_conv_array = self.conv_filter(
             unit_array,
-            temporal,
-            temporal_up,
-            singular,
-            spatial,
+            temporal_fft,
+            self.temporal_up,
+            self.singular,
+            self.spatial,
         )
 
-        with open(
-            Path(self.deconv_dir)
-            / ("temp_temp_chunk_" + str(proc_index) + ".pkl"),
-            "wb",
-        ) as f:
-            pickle.dump(pairwise_conv_array, f)
+        # write straight into this chunk's rows of the shared output
+        for start, pairwise_conv in zip(row_starts, pairwise_conv_array):
+            out[start : start + len(pairwise_conv)] = pairwise_conv
 
     def pairwise_filter_conv(self):
-        # TODO: split based on size limit rather than n_processors
-        units = np.array_split(np.unique(self.up_up_map), self.n_processors)
+        temporal_fft = _temporal_rfft(self.temporal, self.singular)
         if self.multi_processing:
-            ctx = multiprocessing.get_context("spawn")
-            with ctx.Pool(self.n_processors) as pool:
+            # each unit's result fills a block of rows of one array on disk,
+            # which the batch processes map back in (see load_saved_state)
+            units = self.up_up_unique
+            n_rows = np.diff(self.overlap_indptr)[units]
+            row_starts = np.cumsum(n_rows) - n_rows
+            rows_path = os.path.join(self.deconv_dir, "pairwise_conv_rows.npy")
+            rows = np.lib.format.open_memmap(
+                rows_path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(int(n_rows.sum()), self.n_time * 2 - 1),
+            )
+
+            # TODO: split based on size limit rather than n_processors
+            unit_chunks = np.array_split(units, self.n_processors)
+            start_chunks = np.array_split(row_starts, self.n_processors)
+            # threads rather than processes: the FFTs and matrix products
+            # release the GIL, and the threads share the templates' SVD
+            with ThreadPoolExecutor(self.n_processors) as pool:
                 for result in xqdm(
-                    pool.imap_unordered(
+                    pool.map(
                         self.parallel_conv_filter,
-                        enumerate(units),
+                        unit_chunks,
+                        start_chunks,
+                        repeat(temporal_fft),
+                        repeat(rows),
                     ),
                     pbar=self.verbose,
-                    total=len(units),
+                    total=len(unit_chunks),
                     desc="pairwise_filter_conv",
                 ):
                     pass
+            rows.flush()
 
-                # load temp_temp saved files from disk due to memory overload otherwise
-                temp_array = []
-                for i in range(len(units)):
-                    fname = os.path.join(
-                        self.deconv_dir, "temp_temp_chunk_" + str(i) + ".pkl"
+            pairwise_conv_scale = np.ones(self.n_unit, dtype=np.float32)
+            if self.quantize_pairwise_conv:
+                q_path = os.path.join(self.deconv_dir, "pairwise_conv_q.npy")
+                q_rows = np.lib.format.open_memmap(
+                    q_path, mode="w+", dtype=np.int16, shape=rows.shape
+                )
+                for unit2, start, n in zip(units, row_starts, n_rows):
+                    q, pairwise_conv_scale[unit2] = _quantize_int16(
+                        rows[start : start + n]
                     )
-                    with open(fname, "rb") as f:
-                        temp_array.extend(pickle.load(f))
-                    os.remove(fname)
+                    q_rows[start : start + n] = q
+                q_rows.flush()
+                del rows, q_rows
+                os.replace(q_path, rows_path)
+
+            # leave the rows on disk, next to an index of each unit's block.
+            # load_saved_state maps them back in without a copy.
+            np.save(
+                os.path.join(self.deconv_dir, "pairwise_conv_index.npy"),
+                np.c_[units, row_starts, n_rows],
+            )
+            np.save(
+                os.path.join(self.deconv_dir, "pairwise_conv_scale.npy"),
+                pairwise_conv_scale,
+            )
         else:
-            units = np.unique(self.up_up_map)
+            units = self.up_up_unique
             temp_array = []
 
             for k in xqdm(
@@ -416,33 +618,22 @@ class MatchPursuitObjectiveUpsample:
             ):
                 chunk = self.conv_filter(
                     [units[k]],
-                    self.temporal,
+                    temporal_fft,
                     self.temporal_up,
                     self.singular,
                     self.spatial,
                 )
                 temp_array.extend(chunk)
 
-        # initialize empty list and fill only correct locations
-        pairwise_conv = []
-        for i in range(self.n_unit):
-            pairwise_conv.append(None)
-
-        ctr = 0
-        for unit2 in np.unique(self.up_up_map):
-            pairwise_conv[unit2] = temp_array[ctr]
-            ctr += 1
-
-        pairwise_conv = np.array(pairwise_conv, dtype=object)
-
-        if self.multi_processing:
-            # save to disk, don't keep in memory
-            np.save(
-                os.path.join(self.deconv_dir, "pairwise_conv.npy"),
-                pairwise_conv,
-            )
-        else:
+            # fill only the upsampled units which are used
+            pairwise_conv = np.empty(self.n_unit, dtype=object)
+            pairwise_conv_scale = np.ones(self.n_unit, dtype=np.float32)
+            for unit2, pconv in zip(units, temp_array):
+                if self.quantize_pairwise_conv:
+                    pconv, pairwise_conv_scale[unit2] = _quantize_int16(pconv)
+                pairwise_conv[unit2] = pconv
             self.pairwise_conv = pairwise_conv
+            self.pairwise_conv_scale = pairwise_conv_scale
 
     def get_sparse_upsampled_templates(self, save_npy=True, return_orig_map=False):
         """Returns the fully upsampled sparse version of the original templates.
@@ -464,12 +655,7 @@ class MatchPursuitObjectiveUpsample:
         of deconvolution to 0,...,M-1 that corresponds to the sparse upsampled
         templates.
         """
-        down_sample_idx = np.arange(
-            0, self.n_time * self.up_factor, self.up_factor
-        )
-        down_sample_idx = (
-            down_sample_idx + np.arange(0, self.up_factor)[:, None]
-        )
+        up_matrix = self.upsampling_matrix()
 
         # Reordering the upsampling. This is done because we upsampled the time
         # reversed temporal components of the SVD reconstruction of the
@@ -490,9 +676,7 @@ class MatchPursuitObjectiveUpsample:
         orig_map = []
 
         for i in range(self.orig_n_unit):
-            up_temps = signal.resample(
-                self.temps[:, :, i], self.n_time * self.up_factor
-            )[down_sample_idx, :]
+            up_temps = up_matrix @ self.temps[:, :, i]
             up_temps = up_temps.transpose([1, 2, 0])
             # up_temps = up_temps[:, :, reorder_idx]
             skip = self.up_factor // self.unit_up_factor[i]
@@ -531,45 +715,16 @@ class MatchPursuitObjectiveUpsample:
 
     def get_upsampled_templates(self):
         """Returns the fully upsampled version of the original templates."""
-        down_sample_idx = np.arange(
-            0, self.n_time * self.up_factor, self.up_factor
-        )
-        down_sample_idx = (
-            down_sample_idx + np.arange(0, self.up_factor)[:, None]
+        # upsample every channel of every template with one matrix product
+        up_matrix = self.upsampling_matrix()
+        up_temps = (
+            (
+                up_matrix.reshape(-1, self.n_time)
+                @ self.temps.reshape(self.n_time, -1)
+            )
+            .reshape(self.up_factor, self.n_time, self.n_chan, -1)
+            .transpose(3, 0, 1, 2)
         )
-
-        if self.multi_processing:
-            ctx = multiprocessing.get_context("spawn")
-            with ctx.Pool(self.n_processors) as pool:
-                res = []
-                for r in xqdm(
-                    pool.imap(
-                        self.upsample_templates_parallel,
-                        zip(
-                            self.temps.T,
-                            repeat(self.n_time),
-                            repeat(self.up_factor),
-                            repeat(down_sample_idx),
-                        ),
-                    ),
-                    total=len(self.temps.T),
-                    desc="get_upsampled_templates",
-                    pbar=self.verbose,
-                ):
-                    res.append(r)
-        else:
-            res = []
-            for k in range(self.temps.T.shape[0]):
-                res.append(
-                    self.upsample_templates_parallel(
-                        self.temps.T[k],
-                        self.n_time,
-                        self.up_factor,
-                        down_sample_idx,
-                    )
-                )
-
-        up_temps = np.array(res)
         up_temps = (
             up_temps.transpose([2, 3, 0, 1])
             .reshape([self.n_chan, -1, self.n_time])
@@ -592,12 +747,24 @@ class MatchPursuitObjectiveUpsample:
         ).repeat(self.up_factor)
         return up_temps[:, :, reorder_idx]
 
-    def upsample_templates_parallel(
-        template, n_time, up_factor, down_sample_idx
-    ):
-        return signal.resample(template.T, n_time * up_factor)[
-            down_sample_idx, :
-        ]
+    def upsampling_matrix(self):
+        """Linear map from a template to its up_factor time shifts.
+
+        Returns an array of shape (up_factor, n_time, n_time) whose product
+        with a (n_time, n_chan) template equals signal.resample of that
+        template to n_time * up_factor samples, split into its up_factor
+        interleaved phases.
+        """
+        down_sample_idx = np.arange(
+            0, self.n_time * self.up_factor, self.up_factor
+        )
+        down_sample_idx = (
+            down_sample_idx + np.arange(0, self.up_factor)[:, None]
+        )
+        up_matrix = signal.resample(
+            np.eye(self.n_time), self.n_time * self.up_factor
+        )
+        return up_matrix[down_sample_idx].astype(self.temps.dtype)
 
     def correct_shift_deconv_spike_train(self, dec_spike_train):
         """Get time shift corrected version of the deconvolved spike train.
@@ -613,24 +780,50 @@ class MatchPursuitObjectiveUpsample:
         if self.obj_computed:
             return self.obj
 
-        self.conv_result = np.zeros(
-            [self.orig_n_unit, self.data_len + self.n_time - 1],
-            dtype=np.float32,
+        conv_len = self.data_len + self.n_time - 1
+        nfft = fft.next_fast_len(conv_len, real=True)
+
+        # singular-weighted spatial components, (n_unit, rank, n_chan)
+        spatial_singular = self.spatial * self.singular[:, :, None]
+        temporal_fft = fft.rfft(self.temporal, n=nfft, axis=1)
+
+        # convolve every unit at once along time, summing the ranks'
+        # contributions in the frequency domain so that only one inverse
+        # transform is needed
+        conv_fft = np.zeros(
+            (self.orig_n_unit, nfft // 2 + 1), dtype=temporal_fft.dtype
         )
         for rank in range(self.approx_rank):
-            matmul_result = np.matmul(
-                self.spatial[:, rank] * self.singular[:, [rank]], self.data.T
+            matmul_result = np.matmul(spatial_singular[:, rank], self.data.T)
+            conv_fft += (
+                fft.rfft(matmul_result, n=nfft, axis=1)
+                * temporal_fft[:, :, rank]
             )
-            filters = self.temporal[:, :, rank]
-            for unit in range(self.orig_n_unit):
-                self.conv_result[unit, :] += np.convolve(
-                    matmul_result[unit, :], filters[unit], mode="full"
-                )
+        conv_result = fft.irfft(conv_fft, n=nfft, axis=1)[
+            :, :conv_len
+        ].astype(np.float32, copy=False)
+        del conv_fft
 
         # if self.no_amplitude_scaling:
         # the original objective with no amplitude scaling. note that
         # the objective below converges to this one as lambda -> 0
-        self.obj = 2 * self.conv_result - self.norm[:, None]
+        if self.no_amplitude_scaling:
+            # the conv result is not needed later, so build the
+            # objective in its place
+            self.conv_result = None
+            self.obj = conv_result
+            self.obj *= 2
+        else:
+            self.conv_result = conv_result
+            if self.obj_buffer is None or self.obj_buffer.shape != (
+                self.orig_n_unit,
+                conv_len,
+            ):
+                self.obj_buffer = np.empty(
+                    (self.orig_n_unit, conv_len), dtype=np.float32
+                )
+            self.obj = np.multiply(conv_result, 2, out=self.obj_buffer)
+        self.obj -= self.norm[:, None]
         # else:
         #     # the objective is (conv + 1/lambd)^2 / (norm + 1/lambd) - 1/lambd
         #     b = self.conv_result + 1 / self.lambd
@@ -700,19 +893,16 @@ class MatchPursuitObjectiveUpsample:
             return np.array([]), np.array([]), valid_idx, np.array([])
 
         if self.no_amplitude_scaling:
-            high_resolution_peaks = signal.resample(
-                peak_window, self.up_window_len * self.up_factor, axis=0
-            )
+            high_resolution_peaks = self.peak_upsampling_matrix @ peak_window
             shift_idx = np.argmax(
                 high_resolution_peaks[self.zoom_index, :], axis=0
             )
             scalings = np.ones(len(valid_idx))
         else:
             # the objective is (conv + 1/lambd)^2 / (norm + 1/lambd) - 1/lambd
-            high_resolution_conv = signal.resample(
-                self.conv_result[unit_ids, idx][:, valid_idx],
-                self.up_window_len * self.up_factor,
-                axis=0,
+            high_resolution_conv = (
+                self.peak_upsampling_matrix
+                @ self.conv_result[unit_ids, idx][:, valid_idx]
             )
             norms = self.norm[unit_ids[valid_idx]]
 
@@ -743,19 +933,17 @@ class MatchPursuitObjectiveUpsample:
 
     def find_peaks(self):
         """Finds peaks in subtraction differentials of spikes."""
-        max_across_temp = np.max(self.obj, axis=0)
-        spike_times = signal.argrelmax(
+        max_across_temp, best_unit = _max_argmax_over_units(self.obj)
+        spike_times = _thresholded_relmax(
             max_across_temp[self.n_time - 1 : self.obj.shape[1] - self.n_time],
-            order=self.refrac_radius,
-        )[0] + (self.n_time - 1)
-        spike_times = spike_times[
-            max_across_temp[spike_times] > self.threshold
-        ]
+            self.threshold,
+            self.refrac_radius,
+        ) + (self.n_time - 1)
         dist_metric = max_across_temp[spike_times]
         dec_scalings = np.ones(len(spike_times), dtype=self.obj.dtype)
 
         # Upsample the objective and find the best upsampled template.
-        spike_ids = np.argmax(self.obj[:, spike_times], axis=0)
+        spike_ids = best_unit[spike_times]
         upsampled_template_idx, time_shift, valid_idx, scalings = self.high_res_peak(
             spike_times, spike_ids
         )
@@ -791,9 +979,6 @@ class MatchPursuitObjectiveUpsample:
 
     def enforce_refractory(self, spike_train):
         """Enforces refractory period for units."""
-        window = np.arange(
-            -self.adjusted_refrac_radius, self.adjusted_refrac_radius + 1
-        )
         # Re-adjust cluster id's so that they match with the original templates
         unit_idx = spike_train[:, 1] // self.up_factor
         spike_times = spike_train[:, 0]
@@ -816,52 +1001,46 @@ class MatchPursuitObjectiveUpsample:
         # The offset self.n_time - 1 is necessary to revert the spike times
         # back to objective function indices which is the result of convoultion
         # operation.
-        time_idx = (spike_times[:, None] + self.n_time - 1) + window
+        obj_times = spike_times + (self.n_time - 1)
+        # the window excludes its endpoints, +/- adjusted_refrac_radius
+        radius = self.adjusted_refrac_radius - 1
 
         # enforce refractory by setting objective to 0 in invalid regions
-        self.obj[unit_idx[:, None], time_idx[:, 1:-1]] = -np.inf
+        _fill_windows(self.obj, unit_idx, obj_times, radius, -np.inf)
         # added this line when including lambda, since
         # we recompute the objective differently now in subtraction
         if not self.no_amplitude_scaling:
-            self.conv_result[unit_idx[:, None], time_idx[:, 1:-1]] = -np.inf
+            _fill_windows(
+                self.conv_result, unit_idx, obj_times, radius, -np.inf
+            )
 
     def subtract_spike_train(self, spt, scalings):
         """Subtracts a spike train from the original spike_train."""
         present_units = np.unique(spt[:, 1])
-        conv_res_len = self.n_time * 2 - 1
         for i in present_units:
             in_unit = np.flatnonzero(spt[:, 1] == i)
-            unit_spt = spt[in_unit, :]
-            spt_idx = np.arange(0, conv_res_len) + unit_spt[:, :1]
-
-            # Grid idx of subset of channels and times
-            # note: previously, even and odd times were done separately.
-            # I think this was to handle overlaps: in place -= in numpy
-            # won't subtract from the same index twice.
-            # But np.subtract.at will! Switching to that.
-            unit_idx = np.flatnonzero(self.unit_overlap[i])
-            idx = np.ix_(unit_idx, spt_idx.ravel())
+            unit_times = spt[in_unit, 0]
+            unit_idx = self.overlap_indices[
+                self.overlap_indptr[i] : self.overlap_indptr[i + 1]
+            ]
             pconv = self.pairwise_conv[self.up_up_map[i]]
+            # undoes the int16 quantization, if any, along with the scaling
+            pconv_scale = self.pairwise_conv_scale[self.up_up_map[i]]
             # if self.no_amplitude_scaling:
-            np.subtract.at(
+            _subtract_pconv(
                 self.obj,
-                idx,
-                np.tile(
-                    2 * pconv,
-                    len(unit_spt),
-                ),
+                pconv,
+                unit_idx,
+                unit_times,
+                np.full(len(in_unit), 2 * pconv_scale, dtype=np.float32),
             )
             if not self.no_amplitude_scaling:
-                # this particular broadcasting makes things line up with the ravel()
-                # used in the definition of `idx` above
-                to_subtract = (
-                    pconv[:, None, :] * scalings[in_unit][None, :, None]
-                )
-                to_subtract = to_subtract.reshape(*pconv.shape[:-1], -1)
-                np.subtract.at(
+                _subtract_pconv(
                     self.conv_result,
-                    idx,
-                    to_subtract,
+                    pconv,
+                    unit_idx,
+                    unit_times,
+                    (pconv_scale * scalings[in_unit]).astype(np.float32),
                 )
 
                 # now we update the objective just at the changed
@@ -884,9 +1063,24 @@ class MatchPursuitObjectiveUpsample:
     def load_saved_state(self):
         # helper -- initializer for threads
         if self.multi_processing:
-            MatchPursuitObjectiveUpsample.pairwise_conv = np.load(
-                os.path.join(self.deconv_dir, "pairwise_conv.npy"),
-                allow_pickle=True,
+            # views of the rows written by pairwise_filter_conv, so that
+            # the processes share the OS's pages rather than each holding
+            # a copy
+            rows = np.asarray(
+                np.load(
+                    os.path.join(self.deconv_dir, "pairwise_conv_rows.npy"),
+                    mmap_mode="r",
+                )
+            )
+            index = np.load(
+                os.path.join(self.deconv_dir, "pairwise_conv_index.npy")
+            )
+            pairwise_conv = np.empty(self.n_unit, dtype=object)
+            for unit2, start, n_rows in index:
+                pairwise_conv[unit2] = rows[start : start + n_rows]
+            MatchPursuitObjectiveUpsample.pairwise_conv = pairwise_conv
+            MatchPursuitObjectiveUpsample.pairwise_conv_scale = np.load(
+                os.path.join(self.deconv_dir, "pairwise_conv_scale.npy")
             )
 
     def run_array(self, data):
@@ -902,6 +1096,14 @@ class MatchPursuitObjectiveUpsample:
             start_time = time.time()
             print(f"Objective took: {time.time() - start_time:.2f}")
 
+        # collect each iteration's results in buffers which double in size
+        # when they fill up
+        n_found = 0
+        capacity = 1024
+        spike_train = np.empty((capacity, 2), dtype=np.int64)
+        spike_scalings = np.empty(capacity, dtype=np.float32)
+        dist_metric = np.empty(capacity, dtype=np.float64)
+
         ctr = 0
         tot_max = np.inf
         while tot_max > self.threshold and ctr < self.max_iter:
@@ -910,9 +1112,17 @@ class MatchPursuitObjectiveUpsample:
             if len(spt) == 0:
                 break
 
-            self.dec_spike_train = np.concatenate((self.dec_spike_train, spt))
-            self.dec_scalings = np.concatenate((self.dec_scalings, scalings))
-            self.dist_metric = np.concatenate((self.dist_metric, dist_met))
+            n_new = n_found + len(spt)
+            if n_new > capacity:
+                while n_new > capacity:
+                    capacity *= 2
+                spike_train = _grow(spike_train, n_found, capacity)
+                spike_scalings = _grow(spike_scalings, n_found, capacity)
+                dist_metric = _grow(dist_metric, n_found, capacity)
+            spike_train[n_found:n_new] = spt
+            spike_scalings[n_found:n_new] = scalings
+            dist_metric[n_found:n_new] = dist_met
+            n_found = n_new
 
             self.subtract_spike_train(spt, scalings)
 
@@ -924,6 +1134,10 @@ class MatchPursuitObjectiveUpsample:
 
             ctr += 1
 
+        self.dec_spike_train = spike_train[:n_found]
+        self.dec_scalings = spike_scalings[:n_found]
+        self.dist_metric = dist_metric[:n_found]
+
         # order spike times
         idx = np.argsort(self.dec_spike_train[:, 0])
         self.dec_spike_train = self.dec_spike_train[idx]
@@ -942,26 +1156,29 @@ class MatchPursuitObjectiveUpsample:
         s_end = min(self.end_sample, s_start + self.batch_len_samples)
         load_start = max(self.start_sample, s_start - self.buffer)
         load_end = min(self.end_sample, s_end + self.buffer)
-        data = read_data(
-            self.standardized_bin,
-            np.float32,
-            load_start,
-            load_end,
-            self.n_chan,
-        )
 
-        # 0 padding if we were at the edge of the data
+        # edge padding if we were at the edge of the data
         pad_left = pad_right = 0
         if load_start == self.start_sample:
             pad_left = self.buffer
         if load_end == self.end_sample:
             pad_right = self.buffer - (self.end_sample - s_end)
-        if pad_left != 0 or pad_right != 0:
-            data = np.pad(data, [(pad_left, pad_right), (0, 0)], mode="edge")
-        assert data.shape == (
-            2 * self.buffer + s_end - s_start,
-            self.n_chan,
-        )
+
+        # copy the recording straight into the interior of a reused
+        # buffer, and fill the padding from it in place
+        data_shape = (2 * self.buffer + s_end - s_start, self.n_chan)
+        if self.data_buffer is None or self.data_buffer.shape != data_shape:
+            self.data_buffer = np.empty(data_shape, dtype=np.float32)
+        data = self.data_buffer
+        assert pad_left + (load_end - load_start) + pad_right == len(data)
+        recording = np.memmap(
+            self.standardized_bin, dtype=np.float32, mode="r"
+        ).reshape(-1, self.n_chan)
+        data[pad_left : len(data) - pad_right] = recording[load_start:load_end]
+        del recording
+        data[:pad_left] = data[pad_left]
+        if pad_right:
+            data[-pad_right:] = data[-pad_right - 1]
 
         ctr = self.run_array(data)
 
@@ -978,13 +1195,13 @@ class MatchPursuitObjectiveUpsample:
         limit_high = self.buffer + s_end - s_start
         if load_end == self.end_sample:
             limit_high -= self.n_time
-        idx = np.flatnonzero(
-            (self.dec_spike_train[:, 0] >= limit_low)
-            & (self.dec_spike_train[:, 0] < limit_high)
+        # run_array sorted the spikes by time, so this is a slice
+        lo, hi = np.searchsorted(
+            self.dec_spike_train[:, 0], [limit_low, limit_high]
         )
-        self.dec_spike_train = self.dec_spike_train[idx]
-        self.dec_scalings = self.dec_scalings[idx]
-        self.dist_metric = self.dist_metric[idx]
+        self.dec_spike_train = self.dec_spike_train[lo:hi]
+        self.dec_scalings = self.dec_scalings[lo:hi]
+        self.dist_metric = self.dist_metric[lo:hi]
 
         # offset spikes to start of index
         batch_offset = s_start - self.buffer
@@ -1085,7 +1302,9 @@ def deconvolution(
         np.save(template_path, templates)
     else:
         print(f"Loading templates from {template_path}")
-        templates = np.load(template_path)
+        # MatchPursuitObjectiveUpsample makes its own float32 copy, so
+        # there is no need to read this into memory first
+        templates = np.load(template_path, mmap_mode="r")
 
     fname_spike_train = os.path.join(output_directory, "spike_train.npy")
     fname_scalings = os.path.join(output_directory, "scalings.npy")
@@ -1157,18 +1376,12 @@ def deconvolution(
         else:
             mp_object.run(batch_ids, fnames_out)
 
-    deconv_st = []
-    deconv_scalings = []
     print("gathering deconvolution results")
-    for batch_id in range(mp_object.n_batches):
-        fname_out = os.path.join(
-            deconv_dir, "seg_{}_deconv.npz".format(str(batch_id).zfill(6))
-        )
-        with np.load(fname_out) as d:
-            deconv_st.append(d["spike_train"])
-            deconv_scalings.append(d["scalings"])
-    deconv_st = np.concatenate(deconv_st, axis=0)
-    deconv_scalings = np.concatenate(deconv_scalings, axis=0)
+    gathered = _gather_npz(
+        fnames_out, ("spike_train", "scalings"), n_workers=n_processors
+    )
+    deconv_st = gathered["spike_train"]
+    deconv_scalings = gathered["scalings"]
 
     print(f"Number of Spikes deconvolved: {deconv_st.shape[0]}")
 
@@ -1276,36 +1489,23 @@ def deconv(
     templates_up = templates_up.transpose(2, 0, 1)
 
     # gather deconv results
-    deconv_spike_train_upsampled = []
-    deconv_spike_train = []
-    deconv_scalings = []
     print("gathering deconvolution results")
-    for bid in range(mp_object.n_batches):
-
-        fname_out = deconv_dir / f"seg_{bid:06d}_deconv.npz"
-        with np.load(fname_out) as d:
-            st = d["spike_train"]
-            deconv_scalings.append(d["scalings"])
-
-        st[:, 0] += trough_offset
-
-        # usual spike train
-        deconv_st = st.copy()
-        # correct the troughs according to the upsampling
-        # deconv_st = mp_object.correct_shift_deconv_spike_train(deconv_st)
-        deconv_st[:, 1] //= max_upsample
-        deconv_spike_train.append(deconv_st)
-
-        # upsampled spike train
-        st_up = st.copy()
-        st_up[:, 1] = deconv_id_sparse_temp_map[st_up[:, 1]]
-        deconv_spike_train_upsampled.append(st_up)
-
-    deconv_spike_train = np.concatenate(deconv_spike_train, axis=0)
-    deconv_spike_train_upsampled = np.concatenate(
-        deconv_spike_train_upsampled, axis=0
+    gathered = _gather_npz(
+        my_fnames, ("spike_train", "scalings"), n_workers=n_jobs
     )
-    deconv_scalings = np.concatenate(deconv_scalings, axis=0)
+    st = gathered["spike_train"]
+    deconv_scalings = gathered["scalings"]
+    st[:, 0] += trough_offset
+
+    # usual spike train
+    deconv_spike_train = st.copy()
+    # correct the troughs according to the upsampling
+    # deconv_spike_train = mp_object.correct_shift_deconv_spike_train(deconv_spike_train)
+    deconv_spike_train[:, 1] //= max_upsample
+
+    # upsampled spike train
+    deconv_spike_train_upsampled = st
+    deconv_spike_train_upsampled[:, 1] = deconv_id_sparse_temp_map[st[:, 1]]
 
     print(
         f"Number of Spikes deconvolved: {deconv_spike_train_upsampled.shape[0]}"
@@ -1344,12 +1544,21 @@ def get_templates(
     if -1 in unique_labels:
         n_templates -= 1
 
+    # group spike times by label once, keeping their order within a unit
+    order = np.argsort(labels, kind="stable")
+    sorted_times = spike_index[order, 0]
+    unit_bounds = np.searchsorted(
+        labels[order], np.arange(n_templates + 1), side="left"
+    )
+
     templates = np.empty((n_templates, n_times, n_chans))
     units = (
         trange(n_templates, desc="Templates") if pbar else range(n_templates)
     )
     for unit in units:
-        spike_times_unit = spike_index[labels == unit, 0]
+        spike_times_unit = sorted_times[
+            unit_bounds[unit] : unit_bounds[unit + 1]
+        ]
         which = slice(None)
         if spike_times_unit.shape[0] > n_samples:
             which = np.random.choice(
@@ -1,7 +1,7 @@
 import math
 import torch
 from torch import nn
-from typing import Tuple
+from typing import Optional, Tuple
 
 
 class Permute(nn.Module):
@@ -50,6 +50,7 @@ class DiagLinear(nn.Module):
     __constants__ = ["features"]
     features: int
     weight: torch.Tensor
+    bias: Optional[torch.Tensor]
 
     def __init__(
         self, features: int, bias: bool = True, device=None, dtype=None
@@ -75,7 +76,12 @@ class DiagLinear(nn.Module):
     def forward(self, input: torch.Tensor) -> torch.Tensor:
         # recall broadcasting operates on trailing axis, so if input
         # is B x N, this is diag mult on the N axis
-        return input * self.weight + self.bias
+        # (a local, so that TorchScript can refine the Optional)
+        bias = self.bias
+        if bias is None:
+            return input * self.weight
+        # bias + input * weight as one fused op
+        return torch.addcmul(bias, input, self.weight)
 
     def extra_repr(self) -> str:
         return "features={}, bias={}".format(
@@ -1,5 +1,6 @@
 import itertools
 from joblib import Parallel, delayed
+import numba
 import numpy as np
 import multiprocessing
 import h5py
@@ -385,14 +386,43 @@ def grouper(n, iterable):
         yield chunk
 
 
+@numba.njit(nogil=True, parallel=True)
+def ptps_and_maxptps(wfs):
+    """Equivalent to `ptps = wfs.ptp(1); maxptps = ptps.ptp(1)`
+
+    But done in one pass over the (N, T, C) `wfs`, without the min/max
+    temporaries that np.ptp allocates.
+    """
+    N, T, C = wfs.shape
+    ptps = np.empty((N, C), dtype=wfs.dtype)
+    maxptps = np.empty(N, dtype=wfs.dtype)
+    for n in numba.prange(N):
+        mins = wfs[n, 0].copy()
+        maxs = wfs[n, 0].copy()
+        for t in range(1, T):
+            for c in range(C):
+                v = wfs[n, t, c]
+                if v < mins[c]:
+                    mins[c] = v
+                if v > maxs[c]:
+                    maxs[c] = v
+        lo = hi = maxs[0] - mins[0]
+        for c in range(C):
+            ptp = maxs[c] - mins[c]
+            ptps[n, c] = ptp
+            lo = min(lo, ptp)
+            hi = max(hi, ptp)
+        maxptps[n] = hi - lo
+    return ptps, maxptps
+
+
 def _loc_worker(start_end):
     start, end = start_end
     wfs = _loc_worker.wfs[start:end]
     fcs = _loc_worker.firstchans[start:end]
     mcs = _loc_worker.maxchans[start:end]
 
-    ptps = wfs.ptp(1)
-    maxptps = ptps.ptp(1)
+    ptps, maxptps = ptps_and_maxptps(wfs)
 
     x, y, zr, za, alpha = localize_ptps(
         ptps,
@@ -251,6 +251,82 @@ def localize_ptps_index_lm(
     else:
         assert model == "pointsource"
 
+    x, y, z_rel, alpha = _lm_pointsource(
+        ptps,
+        nan_mask,
+        local_geoms,
+        xcom,
+        zcom,
+        y0=y0,
+        max_steps=max_steps,
+        convergence_err=convergence_err,
+        convergence_g=convergence_g,
+        scale_problem=scale_problem,
+        lambd=lambd,
+        nu=nu,
+        min_scale=min_scale,
+    )
+    z_abs = z_rel + geom[maxchans, 1]
+
+    return x, y, z_rel, z_abs, alpha
+
+
+def localize_ptps_firstchans_lm(
+    ptps,
+    geom,
+    firstchans,
+    maxchans,
+    dtype=torch.double,
+    y0=1.0,
+    **lm_kwargs,
+):
+    """Localize PTPs on contiguous channel blocks starting at `firstchans`
+
+    This is the layout used by the older "firstchan" hdf5 files, where
+    spike n lives on channels firstchans[n] : firstchans[n] + C. The fit is
+    the same batched Levenberg-Marquardt as `localize_ptps_index_lm`, so all
+    spikes are solved at once rather than one scipy.optimize call each.
+
+    Returns
+    -------
+    xs, ys, z_rels, z_abss, alphas
+    """
+    N, C = ptps.shape
+    ptps = torch.nan_to_num(torch.as_tensor(ptps, dtype=dtype))
+    geom = torch.as_tensor(geom, dtype=dtype)
+    firstchans = torch.as_tensor(firstchans, dtype=torch.long)
+    maxchans = torch.as_tensor(maxchans, dtype=torch.long)
+
+    local_geoms = geom[firstchans[:, None] + torch.arange(C)]
+    local_geoms[:, :, 1] -= geom[maxchans, 1][:, None]
+    nan_mask = torch.ones_like(ptps)
+
+    com = (ptps[:, :, None] * local_geoms).sum(1) / ptps.sum(1)[:, None]
+    xcom, zcom = com.T
+
+    x, y, z_rel, alpha = _lm_pointsource(
+        ptps, nan_mask, local_geoms, xcom, zcom, y0=y0, **lm_kwargs
+    )
+    z_abs = z_rel + geom[maxchans, 1]
+
+    return x, y, z_rel, z_abs, alpha
+
+
+def _lm_pointsource(
+    ptps,
+    nan_mask,
+    local_geoms,
+    xcom,
+    zcom,
+    y0=1.0,
+    max_steps=250,
+    convergence_err=1e-10,
+    convergence_g=1e-10,
+    scale_problem="hessian",
+    lambd=100.0,
+    nu=10.0,
+    min_scale=1e-2,
+):
     # normalized PTP vectors
     maxptps, _ = torch.max(ptps, dim=1)
     nptps = ptps / maxptps[:, None]
@@ -276,9 +352,8 @@ def localize_ptps_index_lm(
     x, y0, z_rel = locs.T
     y = F.softplus(y0)
     alpha = bfind_alpha(ptps, nan_mask, x, y, z_rel, local_geoms)
-    z_abs = z_rel + geom[maxchans, 1]
 
-    return x, y, z_rel, z_abs, alpha
+    return x, y, z_rel, alpha
 
 
 # -- a pytorch impl of batched newton method
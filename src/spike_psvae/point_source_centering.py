@@ -105,6 +105,7 @@ def relocate_simple(
     z_abs,
     alpha,
     relocate_dims="xyza",
+    out=None,
 ):
     """Shift waveforms according to the point source model
 
@@ -135,6 +136,9 @@ def relocate_simple(
         Rather than shifting X/Z by means of PTPs, use image interpolation
         instead. Might preserve more info. Y/alpha cannot be handled this
         way.
+    out : optional array-like (batches, time, local channels)
+        If supplied, the relocated waveforms are written here rather
+        than into a newly allocated array.
 
     Returns
     -------
@@ -145,7 +149,6 @@ def relocate_simple(
         predicts from the localizations you supplied here.
     """
     B, T, C = waveforms.shape
-    geom = geom.copy()
     ix = firstchans[:, None] + np.arange(C)[None, :]
     local_geom = torch.as_tensor(geom[ix])
     z_mc = geom[maxchans, 1]
@@ -172,10 +175,16 @@ def relocate_simple(
     # ptp predicted from this localization (x,y,z,alpha)
     q = point_source_ptp(local_geom, x, y, z_rel, alpha)
 
-    # relocate by PTP rescaling
-    waveforms_relocated = torch.as_tensor(waveforms) * (
-        r.view(B, C) / q
-    ).unsqueeze(1)
+    # relocate by PTP rescaling. the (B, C) scales are cast down to the
+    # waveforms' dtype, rather than promoting the (B, T, C) result.
+    waveforms = torch.as_tensor(waveforms)
+    scales = (r.view(B, C) / q).unsqueeze(1).to(waveforms.dtype)
+    if out is None:
+        waveforms_relocated = waveforms * scales
+    else:
+        waveforms_relocated = torch.mul(
+            waveforms, scales, out=torch.as_tensor(out)
+        )
 
     return waveforms_relocated, r, q
 
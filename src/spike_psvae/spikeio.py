@@ -1,10 +1,10 @@
 # %%
 """A library for quickly reading spike data from .bin files."""
+from functools import lru_cache
 from pathlib import Path
 import numpy as np
 import torch
 import torch.nn.functional as F
-from os import SEEK_SET
 
 
 # %%
@@ -20,6 +20,31 @@ def get_binary_length_samples(
     return T_samples
 
 
+# %%
+@lru_cache(maxsize=16)
+def _cached_memmap(path, dtype, n_channels, st_size, st_mtime_ns):
+    T_samples = st_size // (np.dtype(dtype).itemsize * n_channels)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(T_samples, n_channels))
+
+
+def binary_memmap(bin_file, n_channels, dtype=np.float32):
+    """Read-only (T_samples, n_channels) memmap of a binary file
+
+    The memmap is shared between calls for the same file, so that reading
+    many small sets of spikes from one recording does not reopen and remap
+    it each time. A file which has changed size or modification time since
+    is mapped again.
+    """
+    stat = Path(bin_file).stat()
+    return _cached_memmap(
+        str(Path(bin_file).resolve()),
+        np.dtype(dtype).str,
+        n_channels,
+        stat.st_size,
+        stat.st_mtime_ns,
+    )
+
+
 # %%
 def get_binary_length(
     input_bin, n_channels, sampling_rate, nsync=0, dtype=np.float32
@@ -187,50 +212,91 @@ def read_waveforms(
 
     # figure out which loads will be skipped in advance
     max_load_time = T_samples - spike_length_samples + trough_offset
-    # this can be sped up with a searchsorted if times are sorted...
-    skipped_idx = np.flatnonzero(
-        (trough_times < trough_offset) | (trough_times > max_load_time)
-    )
-    kept_idx = np.setdiff1d(np.arange(N), skipped_idx)
-    N_load = N - len(skipped_idx)
+    # only the loadable spikes are gathered, so the output is allocated
+    # at its final size rather than trimmed afterwards
+    valid = (trough_times >= trough_offset) & (trough_times <= max_load_time)
+    skipped_idx = np.flatnonzero(~valid)
+    kept_idx = np.flatnonzero(valid)
+    N_load = kept_idx.size
+
+    # slicing a memmap lets the OS page in just what each spike needs,
+    # and the whole gather is a single fancy index rather than a loop
+    load_times = trough_times[kept_idx].astype(np.int64) - trough_offset
+    time_ix = load_times[:, None] + np.arange(spike_length_samples)[None, :]
+    mmap = binary_memmap(bin_file, n_channels, dtype=dtype)
+    if load_ci or load_chans:
+        if load_ci:
+            chan_ix = channel_index[max_channels[kept_idx]]
+        else:
+            chan_ix = channels[kept_idx % channels.shape[0]]
+        # channels past the probe's edge are filled rather than read
+        in_probe = chan_ix < n_channels
+        wfs = mmap[time_ix[:, :, None], np.where(in_probe, chan_ix, 0)[:, None, :]]
+        if dtype==np.int16 or dtype==np.int32: #otherwise cannot fill with nan values
+            wfs = wfs.astype(np.float32)
+        np.copyto(wfs, fill_value, where=~in_probe[:, None, :])
+    else:
+        wfs = mmap[time_ix]
 
-    # allocate output space
     if buffer is not None:
         waveforms = buffer[:N_load]
         assert waveforms.shape == (N_load, spike_length_samples, load_channels)
+        waveforms[:] = wfs
     else:
-        waveforms = np.empty(
-            (N_load, spike_length_samples, load_channels),
+        waveforms = wfs.astype(dtype, copy=False)
+
+    return waveforms.astype(dtype_output, copy=False), skipped_idx
+
+
+# %%
+def read_waveforms_mean(
+    trough_times,
+    bin_file,
+    n_channels,
+    channels=None,
+    trough_offset=42,
+    spike_length_samples=121,
+    dtype=np.float32,
+    batch_size=1024,
+):
+    """Mean waveform of a set of spikes, read from a binary file
+
+    Same as `read_waveforms(...)[0].mean(0)`, but the spikes are read
+    `batch_size` at a time and summed as they go, so that the full
+    (N, T, C) array of waveforms never has to exist at once.
+
+    Returns
+    -------
+    mean : (T, C) float32 array
+        NaN if none of the spikes could be loaded
+    n_loaded : int
+    """
+    trough_times = np.asarray(trough_times)
+    load_channels = (
+        n_channels if channels is None else np.atleast_1d(channels).shape[-1]
+    )
+    running_sum = np.zeros((spike_length_samples, load_channels))
+    n_loaded = 0
+    for i0 in range(0, trough_times.shape[0], batch_size):
+        batch_times = trough_times[i0 : i0 + batch_size]
+        batch_channels = channels
+        if channels is not None and np.ndim(channels) == 2 and len(channels) > 1:
+            batch_channels = channels[i0 : i0 + batch_size]
+        wfs, _ = read_waveforms(
+            batch_times,
+            bin_file,
+            n_channels,
+            channels=batch_channels,
+            trough_offset=trough_offset,
+            spike_length_samples=spike_length_samples,
             dtype=dtype,
         )
+        running_sum += wfs.sum(0)
+        n_loaded += wfs.shape[0]
 
-    load_times = trough_times - trough_offset
-    offsets = (
-        load_times.astype(np.int64) * np.dtype(dtype).itemsize * n_channels
-    )
-    with open(bin_file, "rb") as fin:
-        for i, spike_ix in enumerate(kept_idx):
-            fin.seek(offsets[spike_ix], SEEK_SET)
-            wf = np.fromfile(
-                fin,
-                dtype=dtype,
-                count=spike_length_samples * n_channels,
-            ).reshape(spike_length_samples, n_channels)
-
-            if load_ci:
-                if dtype==np.int16 or dtype==np.int32: #otherwise cannot fill with nan values
-                    wf = wf.astype(np.float32)
-                wf = np.pad(wf, [(0, 0), (0, 1)], constant_values=fill_value)
-                wf = wf[:, channel_index[max_channels[spike_ix]]]
-            elif load_chans:
-                if dtype==np.int16 or dtype==np.int32:
-                    wf = wf.astype(np.float32)
-                wf = np.pad(wf, [(0, 0), (0, 1)], constant_values=fill_value)
-                wf = wf[:, channels[spike_ix % channels.shape[0]]]
-
-            waveforms[i] = wf
-
-    return waveforms.astype(dtype_output), skipped_idx
+    if not n_loaded:
+        return np.full(running_sum.shape, np.nan, dtype=np.float32), 0
+    return (running_sum / n_loaded).astype(np.float32), n_loaded
 
 
 # %%
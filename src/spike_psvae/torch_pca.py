@@ -0,0 +1,149 @@
+import math
+
+import torch
+
+
+class TorchIncrementalPCA:
+    """sklearn's IncrementalPCA, with the running fit kept in torch
+
+    Each partial_fit is one SVD of the stacked (previous components,
+    centered batch, mean correction) matrix, as in sklearn, but done on
+    `device` so the components stay resident on the GPU when there is one.
+    """
+
+    def __init__(self, n_components, device=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.n_components = n_components
+        self.device = torch.device(device)
+        self.n_samples_seen_ = 0
+        self.mean_ = self.components_ = self.singular_values_ = None
+        self._components_T = None
+
+    def partial_fit(self, X):
+        X = torch.as_tensor(X).to(self.device, torch.float, non_blocking=True)
+        n_new = X.shape[0]
+        n_total = self.n_samples_seen_ + n_new
+
+        batch_mean = X.mean(0)
+        X = X - batch_mean
+        if self.n_samples_seen_:
+            mean_correction = math.sqrt(self.n_samples_seen_ * n_new / n_total)
+            mean_correction = mean_correction * (self.mean_ - batch_mean)
+            X = torch.cat(
+                (
+                    self.singular_values_[:, None] * self.components_,
+                    X,
+                    mean_correction[None],
+                )
+            )
+            self.mean_ = self.mean_ + (n_new / n_total) * (batch_mean - self.mean_)
+        else:
+            self.mean_ = batch_mean
+
+        _, S, Vt = torch.linalg.svd(X, full_matrices=False)
+        # sklearn's svd_flip sign convention: largest loading is positive
+        maxabs = Vt.abs().argmax(dim=1)
+        Vt *= torch.sign(Vt[torch.arange(len(Vt)), maxabs])[:, None]
+
+        self.components_ = Vt[: self.n_components]
+        self._components_T = None
+        self.singular_values_ = S[: self.n_components]
+        self.n_samples_seen_ = n_total
+        return self
+
+    def transform(self, X):
+        X = torch.as_tensor(X).to(self.device, torch.float, non_blocking=True)
+        if self._components_T is None:
+            # cached as a contiguous (d, K) so each projection is a plain GEMM
+            self._components_T = self.components_.T.contiguous()
+        return ((X - self.mean_) @ self._components_T).cpu().numpy()
+
+
+class TorchRandomizedPCA:
+    """Randomized PCA (Halko et al.) over streamed batches
+
+    The first pass sketches the centered data as Y = (X - mean) @ Omega for
+    a Gaussian Omega with n_components + n_oversamples columns, and the
+    next accumulates B = Q.T @ (X - mean) for Q an orthonormal basis of Y's
+    range. The components come from one small SVD of B. So, each batch
+    costs a matmul per pass rather than an SVD as in TorchIncrementalPCA.
+
+    Without power iterations, noise in the trailing spectrum leaks into
+    the sketch and the components can be far off. Each power iteration
+    (see power_iteration) re-sketches with Omega an orthonormal basis of
+    B.T, which costs one more pair of passes. Every pass must see the
+    batches in the same order, and the loadings (Q @ U * S, as in sklearn's
+    fit_transform) come out of the last one.
+
+    Usage: sketch() each batch, end_sketch(); then n_iter times: accumulate()
+    each batch, power_iteration(), sketch() each batch, end_sketch(); and
+    last, accumulate() each batch and finish().
+    """
+
+    def __init__(
+        self, n_components, n_samples, n_features, n_oversamples=10, device=None, seed=0
+    ):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.n_components = n_components
+        self.n_samples = n_samples
+        self.device = torch.device(device)
+        rank = min(n_components + n_oversamples, n_samples, n_features)
+        gen = torch.Generator().manual_seed(seed)
+        self.omega = torch.randn(n_features, rank, generator=gen).to(self.device)
+        self.sum_ = torch.zeros(n_features, device=self.device)
+        self.Y = torch.empty(n_samples, rank, device=self.device)
+        self.mean_ = self.components_ = self.singular_values_ = None
+        self._components_T = None
+
+    def sketch(self, start, X):
+        X = torch.as_tensor(X).to(self.device, torch.float, non_blocking=True)
+        if self.mean_ is None:
+            self.sum_ += X.sum(0)
+        torch.matmul(X, self.omega, out=self.Y[start : start + len(X)])
+
+    def end_sketch(self):
+        if self.mean_ is None:
+            self.mean_ = self.sum_ / self.n_samples
+        self.Y -= self.mean_ @ self.omega
+        self.Q, _ = torch.linalg.qr(self.Y)
+        self.B = torch.zeros_like(self.omega.T)
+        del self.Y, self.omega
+
+    def accumulate(self, start, X):
+        X = torch.as_tensor(X).to(self.device, torch.float, non_blocking=True)
+        self.B.addmm_(self.Q[start : start + len(X)].T, X)
+
+    def _center_B(self):
+        self.B -= self.Q.sum(0)[:, None] * self.mean_[None]
+
+    def power_iteration(self):
+        """Start a new sketch pass with Omega an orthonormal basis of B.T"""
+        self._center_B()
+        self.omega, _ = torch.linalg.qr(self.B.T)
+        self.Y = torch.empty_like(self.Q)
+        del self.Q, self.B
+
+    def finish(self):
+        self._center_B()
+        U, S, Vt = torch.linalg.svd(self.B, full_matrices=False)
+        # sklearn's svd_flip sign convention: largest loading is positive
+        maxabs = Vt.abs().argmax(dim=1)
+        signs = torch.sign(Vt[torch.arange(len(Vt)), maxabs])
+        Vt *= signs[:, None]
+        U *= signs[None, :]
+
+        K = self.n_components
+        self.components_ = Vt[:K]
+        self.singular_values_ = S[:K]
+        self.loadings_ = (self.Q @ U[:, :K]) * S[:K]
+        del self.Q, self.B
+        return self
+
+    def transform(self, X):
+        X = torch.as_tensor(X).to(self.device, torch.float, non_blocking=True)
+        if self._components_T is None:
+            # cached as a contiguous (d, K) so each projection is a plain GEMM
+            self._components_T = self.components_.T.contiguous()
+        return ((X - self.mean_) @ self._components_T).cpu().numpy()
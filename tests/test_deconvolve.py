@@ -0,0 +1,182 @@
+import numpy as np
+from scipy import signal
+from spike_psvae import deconvolve
+
+spike_length_samples = 121
+trough_offset_samples = 42
+sampling_rate = 30_000
+
+
+def synthetic_recording(seed=0, n_seconds=3, n_channels=8, n_units=3, n_spikes=100):
+    """Noise plus n_spikes well-separated spikes per unit, and the templates"""
+    rg = np.random.default_rng(seed)
+    t = np.arange(spike_length_samples)
+    trace = -np.exp(-0.5 * ((t - trough_offset_samples) / 3) ** 2)
+    trace += 0.4 * np.exp(-0.5 * ((t - trough_offset_samples - 13) / 6) ** 2)
+    templates = np.zeros((n_units, spike_length_samples, n_channels), "float32")
+    for k in range(n_units):
+        amps = np.exp(-0.5 * ((np.arange(n_channels) - 2 * k - 1) / 1.5) ** 2)
+        templates[k] = trace[:, None] * (15 + 5 * k) * amps[None, :]
+
+    n_samples = n_seconds * sampling_rate
+    rec = rg.normal(size=(n_samples, n_channels)).astype("float32")
+    times = []
+    for k in range(n_units):
+        candidates = np.arange(200, n_samples - 200, 150)
+        st = np.sort(rg.choice(candidates, n_spikes, replace=False))
+        for s in st:
+            start = s - trough_offset_samples
+            rec[start : start + spike_length_samples] += templates[k]
+        times.append(st)
+    return rec, templates, times
+
+
+def test_run_several_batches(tmp_path):
+    rec, templates, times = synthetic_recording()
+    rec.tofile(tmp_path / "rec.bin")
+
+    mp_object = deconvolve.MatchPursuitObjectiveUpsample(
+        templates=templates,
+        deconv_dir=tmp_path,
+        standardized_bin=tmp_path / "rec.bin",
+        threshold=50,
+        lambd=0.001,
+        allowed_scale=0.1,
+    )
+    assert mp_object.n_batches == 3
+    batch_ids = np.arange(mp_object.n_batches)
+    fnames = [tmp_path / f"seg_{bid}.npz" for bid in batch_ids]
+    mp_object.run(batch_ids, fnames)
+
+    n_found = 0
+    for fname in fnames:
+        with np.load(fname) as d:
+            n = len(d["spike_train"])
+            assert d["scalings"].shape == (n,)
+            assert d["dist_metric"].shape == (n,)
+            assert np.all(np.diff(d["spike_train"][:, 0]) >= 0)
+        n_found += n
+    assert n_found == sum(map(len, times))
+
+
+def test_peak_upsampling_matches_resample(tmp_path):
+    rec, templates, _ = synthetic_recording(n_seconds=1)
+    rec.tofile(tmp_path / "rec.bin")
+    mp_object = deconvolve.MatchPursuitObjectiveUpsample(
+        templates=templates,
+        deconv_dir=tmp_path,
+        standardized_bin=tmp_path / "rec.bin",
+    )
+    rg = np.random.default_rng(0)
+    window = rg.normal(size=(mp_object.up_window_len, 20))
+    expected = signal.resample(
+        window, mp_object.up_window_len * mp_object.up_factor, axis=0
+    )
+    np.testing.assert_allclose(
+        mp_object.peak_upsampling_matrix @ window, expected, atol=1e-10
+    )
+
+
+def test_deconv_recovers_spike_train(tmp_path):
+    rec, templates, times = synthetic_recording()
+    rec.tofile(tmp_path / "rec.bin")
+    res = deconvolve.deconv(tmp_path / "rec.bin", tmp_path / "deconv", templates)
+
+    spike_train = res["deconv_spike_train"]
+    assert len(list((tmp_path / "deconv").glob("seg_*_deconv.npz"))) == 3
+    assert res["deconv_scalings"].shape == (len(spike_train),)
+    assert res["deconv_spike_train_upsampled"].shape == spike_train.shape
+    for k, st in enumerate(times):
+        found = np.sort(spike_train[spike_train[:, 1] == k, 0])
+        assert found.shape == st.shape
+        assert np.abs(found - st).max() <= 1
+
+
+def test_thresholded_relmax_matches_argrelmax():
+    rg = np.random.default_rng(0)
+    x = rg.normal(size=5000)
+    # plateaus, which argrelmax does not count as maxima
+    x[100:103] = 10.0
+    # peaks at the ends, which argrelmax excludes
+    x[0] = x[-1] = 10.0
+    for order in (1, 5, 20):
+        for threshold in (-np.inf, 0.0, 2.0):
+            expected = signal.argrelmax(x, order=order)[0]
+            expected = expected[x[expected] > threshold]
+            np.testing.assert_array_equal(
+                deconvolve._thresholded_relmax(x, threshold, order), expected
+            )
+
+
+def test_subtract_pconv_matches_subtract_at():
+    rg = np.random.default_rng(0)
+    out = rg.normal(size=(10, 500)).astype(np.float32)
+    pconv = rg.normal(size=(4, 41)).astype(np.float32)
+    chans = np.array([0, 3, 4, 9])
+    # overlapping windows and a repeated time
+    times = np.array([5, 20, 20, 100, 450])
+    scales = rg.uniform(0.5, 2, size=len(times)).astype(np.float32)
+
+    expected = out.copy()
+    t_idx = times[:, None] + np.arange(pconv.shape[1])
+    np.subtract.at(
+        expected,
+        np.ix_(chans, t_idx.ravel()),
+        (pconv[:, None, :] * scales[None, :, None]).reshape(len(chans), -1),
+    )
+    deconvolve._subtract_pconv(out, pconv, chans, times, scales)
+    np.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_max_argmax_over_units():
+    rg = np.random.default_rng(0)
+    obj = rg.normal(size=(7, 10_000)).astype(np.float32)
+    # all -inf columns (argmax 0) and ties (first unit wins)
+    obj[:, :50] = -np.inf
+    obj[3, 60] = obj[5, 60] = 100.0
+    maxes, argmaxes = deconvolve._max_argmax_over_units(obj)
+    np.testing.assert_array_equal(maxes, obj.max(axis=0))
+    np.testing.assert_array_equal(argmaxes, obj.argmax(axis=0))
+
+
+def test_fill_windows():
+    rg = np.random.default_rng(0)
+    out = rg.normal(size=(5, 100))
+    rows = np.array([0, 2, 2, 4])
+    # windows clipped at both ends
+    centers = np.array([1, 50, 53, 98])
+    radius = 4
+    expected = out.copy()
+    for row, center in zip(rows, centers):
+        expected[row, max(center - radius, 0) : center + radius + 1] = -np.inf
+    deconvolve._fill_windows(out, rows, centers, radius, -np.inf)
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_gather_npz(tmp_path):
+    rg = np.random.default_rng(0)
+    fnames = []
+    for i, n in enumerate((5, 0, 12, 3)):
+        fname = tmp_path / f"seg_{i}.npz"
+        np.savez(
+            fname,
+            spike_train=rg.integers(0, 100, size=(n, 2)),
+            scalings=rg.normal(size=n).astype(np.float32),
+        )
+        fnames.append(fname)
+
+    headers = deconvolve._npz_headers(fnames[2])
+    assert headers["spike_train"] == ((12, 2), np.dtype(np.int64))
+    assert headers["scalings"] == ((12,), np.dtype(np.float32))
+
+    keys = ("spike_train", "scalings")
+    for n_workers in (1, 3):
+        gathered = deconvolve._gather_npz(fnames, keys, n_workers=n_workers)
+        for key in keys:
+            expected = []
+            for fname in fnames:
+                with np.load(fname) as d:
+                    expected.append(d[key])
+            expected = np.concatenate(expected, axis=0)
+            assert gathered[key].dtype == expected.dtype
+            np.testing.assert_array_equal(gathered[key], expected)
@@ -15,6 +15,17 @@ def test_ptp():
     assert np.array_equal(spiketorch.ptp(torch.tensor(x), 1).numpy(), np.ptp(x, 1))
 
 
+def test_absmax():
+    rg = np.random.default_rng(0)
+
+    x = rg.normal(size=(10, 20, 30))
+    for dim in range(3):
+        assert np.array_equal(
+            spiketorch.absmax(torch.tensor(x), dim).numpy(), np.abs(x).max(dim)
+        )
+        assert np.array_equal(spiketorch.absmax(x, dim), np.abs(x).max(dim))
+
+
 def test_isin_sorted():
     x = torch.arange(5)
     y = torch.arange(10)
@@ -0,0 +1,59 @@
+import numpy as np
+from sklearn.decomposition import PCA
+from spike_psvae.torch_pca import TorchRandomizedPCA
+
+
+def noisy_low_rank(n_samples=3000, n_features=120, rank=40, decay=0.9, seed=0):
+    """Slowly decaying spectrum plus a flat noise floor and an offset"""
+    rg = np.random.default_rng(seed)
+    U = np.linalg.qr(rg.normal(size=(n_samples, rank)))[0]
+    V = np.linalg.qr(rg.normal(size=(n_features, rank)))[0]
+    s = 300 * decay ** np.arange(rank)
+    X = (U * s) @ V.T
+    X += 0.5 * rg.normal(size=X.shape) + rg.normal(size=n_features)
+    return X.astype(np.float32)
+
+
+def randomized_pca(X, n_components, n_iter, batch_size=1000):
+    N, d = X.shape
+    pca = TorchRandomizedPCA(n_components, N, d, device="cpu")
+    starts = range(0, N, batch_size)
+    for start in starts:
+        pca.sketch(start, X[start : start + batch_size])
+    pca.end_sketch()
+    for _ in range(n_iter):
+        for start in starts:
+            pca.accumulate(start, X[start : start + batch_size])
+        pca.power_iteration()
+        for start in starts:
+            pca.sketch(start, X[start : start + batch_size])
+        pca.end_sketch()
+    for start in starts:
+        pca.accumulate(start, X[start : start + batch_size])
+    return pca.finish()
+
+
+def test_randomized_pca_matches_sklearn():
+    X = noisy_low_rank()
+    K = 5
+    expected = PCA(K).fit(X)
+
+    pca = randomized_pca(X, K, n_iter=4)
+    components = pca.components_.numpy()
+    np.testing.assert_allclose(pca.mean_.numpy(), expected.mean_, atol=1e-4)
+    np.testing.assert_allclose(
+        pca.singular_values_.numpy(), expected.singular_values_, rtol=1e-3
+    )
+    # same sign convention as sklearn
+    np.testing.assert_allclose(components, expected.components_, atol=1e-2)
+    np.testing.assert_allclose(
+        pca.loadings_.numpy(), expected.transform(X), rtol=1e-2, atol=1e-1
+    )
+    np.testing.assert_allclose(
+        pca.transform(X), expected.transform(X), rtol=1e-2, atol=1e-1
+    )
+
+    # without power iterations, the noise floor pulls the sketch off
+    pca = randomized_pca(X, K, n_iter=0)
+    cosines = np.abs(np.sum(pca.components_.numpy() * expected.components_, 1))
+    assert cosines.min() < 0.9